@@ -50,6 +50,23 @@ def test_parking_update():
     
     return response.status_code == 200
 
+def test_partial_update():
+    """Test sending only the parking spaces that changed"""
+    print("1b. Uploading changed parking space only...")
+    test_data = [
+        {
+            "ID": 2,
+            "IsOccupied": True,
+            "LicensePlateNumber": "GHI-9012",
+            "LicensePlateColor": "White"
+        }
+    ]
+    response = requests.post(f"{BASE_URL}/parking/update", json=test_data)
+    print(f"Status code: {response.status_code}")
+    print(f"Response: {json.dumps(response.json(), indent=2)}\n")
+
+    return response.status_code == 200
+
 def test_parking_status():
     """Test retrieving parking lot status"""
     print("2. Getting parking lot status...")
@@ -168,6 +185,7 @@ def main():
     try:
         # Run basic tests
         if test_parking_update():
+            test_partial_update()
             status_data = test_parking_status()
             test_my_status()
             
@@ -11,7 +11,7 @@ import torch.backends.cudnn as cudnn
 from numpy import random
 
 from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from utils.datasets import LoadStreams, LoadImages, letterbox, img_formats
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
     scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
 from utils.plots import plot_one_box
@@ -20,121 +20,124 @@ from utils.torch_utils import select_device, load_classifier, time_synchronized,
 # Import custom tools
 from utils.parking_utils import detect_color
 
-list = []
 
-def detect(save_img=False):
-    
-    source, weights, view_img, save_txt, imgsz, trace = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size, not opt.no_trace
-    save_img = not opt.nosave and not source.endswith('.txt')  # save inference images
-    # Directories
-    
-    # Initialize
-    set_logging()
-    device = select_device(opt.device)
-    half = device.type != 'cpu'  # half precision only supported on CUDA
-    
-    t3 = time_synchronized()
-    # Load model 1.8s
-    model = attempt_load(weights, map_location=device)  # load FP32 model
-    stride = int(model.stride.max())  # model stride
-    imgsz = check_img_size(imgsz, s=stride)  # check img_size
-    t4 = time_synchronized()
-    print(f'----Done. ({(1E3 * (t4 - t3)):.1f}ms) TIME----')
-
-    trace = False
-    #opt.augment = False
-    if trace:
-        model = TracedModel(model, device, opt.img_size)
-
-    if half:
-        model.half()  # to FP16
-    
-    # Set Dataloader
-    dataset = LoadImages(source, img_size=imgsz, stride=stride)
-
-    # Get names and colors
-    names = model.names
-    colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
-    
-    # Run inference
-    if device.type != 'cpu':
-        model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
-    old_img_w = old_img_h = imgsz
-    old_img_b = 1
-    numberList = []
-    plateList = []
-    colorList = []
-    
-    for path, img, im0s, vid_cap in dataset:
-
-        img = torch.from_numpy(img).to(device)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
+class PlateResult:
+    """Recognition result of one license plate crop"""
+    def __init__(self, slot, number="None", color="None"):
+        self.slot = slot
+        self.number = number
+        self.color = color
 
-        # Warmup
-        if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
-            old_img_b = img.shape[0]
-            old_img_h = img.shape[2]
-            old_img_w = img.shape[3]
-            for i in range(3):
-                model(img, augment=opt.augment)[0]
 
-        # Inference
+class PlateRecognizer:
+    """Long-lived license plate recognizer, the plate model is loaded once and reused for every crop"""
+    def __init__(self, weights='weights/yolov7_plate_0421.pt', device='', img_size=160, conf_thres=0.7,
+                 iou_thres=0.45, classes=None, agnostic_nms=False, augment=False, batch_size=16):
+        self.device = select_device(device) if isinstance(device, str) else device
+        self.half = self.device.type != 'cpu'  # half precision only supported on CUDA
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.classes = classes
+        self.agnostic_nms = agnostic_nms
+        self.augment = augment
+        self.batch_size = batch_size  # max crops per forward pass
+
         t1 = time_synchronized()
-        with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
-            pred = model(img, augment=opt.augment)[0]
+        # Load model 1.8s
+        self.model = attempt_load(weights, map_location=self.device)  # load FP32 model
+        self.stride = int(self.model.stride.max())  # model stride
+        self.img_size = check_img_size(img_size, s=self.stride)  # check img_size
         t2 = time_synchronized()
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
-        t3 = time_synchronized()
+        print(f'----Plate model loaded. ({(1E3 * (t2 - t1)):.1f}ms)----')
+
+        if self.half:
+            self.model.half()  # to FP16
+        self.names = self.model.module.names if hasattr(self.model, 'module') else self.model.names
+
+        # Run inference once
+        if self.device.type != 'cpu':
+            self.model(torch.zeros(1, 3, self.img_size, self.img_size).to(self.device).type_as(next(self.model.parameters())))
+
+    def recognize(self, crops):
+        """Recognize license plate crops in batched forward passes
+
+        Arguments:
+            crops: list of (slot, BGR image) pairs
+        Returns:
+            list of PlateResult, one per crop, in input order
+        """
+        results = []
+        for i in range(0, len(crops), self.batch_size):
+            results += self._recognize_batch(crops[i:i + self.batch_size])
+        return results
+
+    def _recognize_batch(self, crops):
+        if not crops:
+            return []
+
+        # Letterbox every crop to the same square input and stack, Nx3x160x160
+        img = [letterbox(im0, self.img_size, auto=False, stride=self.stride)[0] for _, im0 in crops]
+        img = np.stack(img, 0)
+        img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x160x160
+        img = np.ascontiguousarray(img)
+
+        img = torch.from_numpy(img).to(self.device)
+        img = img.half() if self.half else img.float()  # uint8 to fp16/32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+
+        # Inference
+        with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
+            pred = self.model(img, augment=self.augment)[0]
 
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-            p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
- 
-            p = Path(p)  # to Path
+        # Apply NMS once over the whole batch
+        pred = non_max_suppression(pred, self.conf_thres, self.iou_thres, classes=self.classes,
+                                   agnostic=self.agnostic_nms)
 
+        # Split per-crop results back out
+        results = []
+        for (slot, im0), det in zip(crops, pred):
+            chars = []
             if len(det):
-                
                 # Rescale boxes from img_size to im0 size
                 det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+                # Read characters from left to right
+                for *xyxy, conf, cls in det[torch.argsort(det[:, 0])]:
+                    chars.append(self.names[int(cls)])  # Each detected character
 
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                sorted_indices = torch.argsort(det[:, 0], descending=True)  # Sort by first column, returns sorted indices
-                sorted_tensor = det[sorted_indices]  # Use sorted indices to rearrange original tensor
-
-
-                for *xyxy, conf, cls in reversed(sorted_tensor):
-                    label = f'{names[int(cls)]} {conf:.2f}'
-                    list.append(names[int(cls)])  # Each detected character
-                    plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=1)
-            
-            print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
-            
-            color_plate = detect_color(p)  # Detect color           
-            Str = "".join(list)  # Convert list to string
-            #print(Str+" "+color_plate)  # Output result
-            plateList.append(Str)
-            colorList.append(color_plate) 
-            number_string = p.name.split(".")[0]
-            numberList.append(int(number_string))
-            list.clear()
-    print(numberList)
-    print(plateList)
-    print(colorList)     
+            results.append(PlateResult(slot, "".join(chars), detect_color(im0)))
+        return results
+
+
+def load_plate_crops(folder):
+    """Load plate crops saved as <slot>.jpg from a folder as (slot, image) pairs"""
+    crops = []
+    for file in sorted(Path(folder).glob('*.*')):
+        if file.suffix[1:].lower() in img_formats:
+            img = cv2.imread(str(file))  # BGR
+            if img is not None:
+                crops.append((int(file.stem), img))
+    return crops
+
+
+def detect(save_img=False):
+    set_logging()
+    recognizer = PlateRecognizer(opt.weights, opt.device, opt.img_size, opt.conf_thres, opt.iou_thres,
+                                 classes=opt.classes, agnostic_nms=opt.agnostic_nms, augment=opt.augment)
+
+    t1 = time_synchronized()
+    results = recognizer.recognize(load_plate_crops(opt.source))
+    t2 = time_synchronized()
+    print(f'Done. ({(1E3 * (t2 - t1)):.1f}ms) Recognize {len(results)} plates')
+
+    print([result.slot for result in results])
+    print([result.number for result in results])
+    print([result.color for result in results])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', nargs='+', type=str, default='weights/yolov7_plate_0421.pt', help='model.pt path(s)')
-    parser.add_argument('--source', type=str, default='platePic', help='source')  # file/folder, 0 for webcam
-    #parser.add_argument('--source', type=str, default='pic/tester/HSR-1785 02.jpg', help='source')  
+    parser.add_argument('--source', type=str, default='platePic', help='source')  # folder of <slot>.jpg crops
+    #parser.add_argument('--source', type=str, default='pic/tester/HSR-1785 02.jpg', help='source')
     parser.add_argument('--img-size', type=int, default= 160, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.7, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
@@ -160,4 +163,4 @@ if __name__ == '__main__':
                 strip_optimizer(opt.weights)
         else:
             detect()
-            
\ No newline at end of file
+
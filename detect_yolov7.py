@@ -3,7 +3,6 @@ import argparse
 import time
 from pathlib import Path
 import os
-import re
 import requests
 import json
 
@@ -13,9 +12,7 @@ import torch.backends.cudnn as cudnn
 
 #---------samadd----------------
 import numpy as np
-from shapely.geometry import Polygon as shapely_poly
 import pickle
-import subprocess
 import datetime
 #---------samadd----------------
 
@@ -29,111 +26,61 @@ from utils.plots import plot_one_box
 from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
 
 # Import custom tools
-from utils.parking_utils import Car, normalize_license_plate, convert_to_boxes, shape_poly, clear_images_in_folder, send_parking_data
+from utils.parking_utils import Car, SlotMasks, normalize_license_plate, convert_to_boxes, assign_parking, EventOutbox, TelemetrySender, \
+    StageTimer, serve_timing, PipelineStage, MotionGate, RoiTiles, \
+    VehicleTracker
+from utils.lot_layout import LOT_CONFIG, load_lot_layout
+from detect_rec_plate import PlateRecognizer
 
 webcam_2 = 0
-F_subprocess = 1
 
 # API configuration - can be set via environment variable
 API_URL = os.environ.get('API_URL', 'https://parking-management-api-lyvg.onrender.com/api/parking/update')
 print(f"Using API URL: {API_URL}")
 
-# Initialize car objects
-cars = [Car() for _ in range(4)]
-hasCar = [False, False, False, False]
-
-recognition_results = [
-    {
-        'ID': 1,
-        'IsOccupied': False,
-        'LicensePlateColor': 'None',
-        'LicensePlateNumber': 'None'
-    },
-    {
-        'ID': 2,
-        'IsOccupied': False,
-        'LicensePlateColor': 'None',
-        'LicensePlateNumber': 'None'
-    },
-    {
-        'ID': 3,
-        'IsOccupied': False,
-        'LicensePlateColor': 'None',
-        'LicensePlateNumber': 'None'
-    },
-    {
-        'ID': 4,
-        'IsOccupied': False,
-        'LicensePlateColor': 'None',
-        'LicensePlateNumber': 'None'
-    }
-]
-
-def sendData():    
-    """Send data to backend API"""
-    try:
-        # Prepare data to send
-        api_data = []
-        for result in recognition_results:
-            api_data.append({
-                'ID': result['ID'],
-                'IsOccupied': result['IsOccupied'],
-                'LicensePlateNumber': result['LicensePlateNumber'],
-                'LicensePlateColor': result['LicensePlateColor']
-            })
-        
-        # Send to API
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(API_URL, json=api_data, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            print("? Data sent successfully")
-            print(f"Response: {response.json()}")
-        else:
-            print(f"? Data sending failed: {response.status_code}")
-            print(f"Error message: {response.text}")
-    
-    except requests.exceptions.ConnectionError:
-        print("? Cannot connect to API service")
-    except requests.exceptions.Timeout:
-        print("? API request timeout")
-    except Exception as e:
-        print(f"? Error sending data: {e}")
-
-def hasCar_changed():
-    global cars, hasCar
-    for i in range(4):
-        if cars[i].has_parking != hasCar[i]:  # If status changed
-            if cars[i].has_parking:
-                hasCar[i] = cars[i].has_parking
-                return True
+# Slot state, sized from the lot layout (lot.yaml) in init_slots()
+lot = None
+cars = []
+recognition_results = []
+
+def init_slots(layout):
+    """Initialize car objects and recognition results for every slot of the lot layout"""
+    global lot, cars, recognition_results
+    lot = layout
+    cars = [Car() for _ in range(len(layout))]
+    recognition_results = [
+        {
+            'ID': slot_id,
+            'IsOccupied': False,
+            'LicensePlateColor': 'None',
+            'LicensePlateNumber': 'None'
+        } for slot_id in layout.slot_ids
+    ]
+
+def compute_parking_moto(parked_car_boxes, motorcycles_boxes, number_plates_boxes,cars,imgs,tracker):
+    """Update cars[i].has_parking and cars[i].track, return (slot, plate image) crops of tracks without a plate read"""
+    vehicle, plate = assign_parking(parked_car_boxes, motorcycles_boxes, number_plates_boxes)
+    tracks = tracker.update(motorcycles_boxes)
+    number_plates_boxes = number_plates_boxes.tolist()
+    plate_crops = []
+    for i, (v, n) in enumerate(zip(vehicle.tolist(), plate.tolist())):
+        cars[i].track = tracks[v] if v >= 0 else None  # set first, has_parking implies a track
+        if v >= 0:
+            tracker.park(tracks[v])
+        cars[i].has_parking = v >= 0
+        if n >= 0 and tracker.needs_read(cars[i].track):
+            x_min, y_min, x_max, y_max = number_plates_boxes[n]
+            if webcam_2:
+                license_plate_image = imgs[int(y_min):int(y_max), int(x_min):int(x_max)]
             else:
-                hasCar[i] = cars[i].has_parking
-                return False
-    return False
-
-def compute_parking_moto(parked_car_boxes_poly, motorcycles_boxes_poly, number_plates_boxes_poly,cars,imgs):
-    for i, pol1 in enumerate(parked_car_boxes_poly):
-        cars[i].has_parking = False 
-        for pol2 in motorcycles_boxes_poly:
-            polygon_intersection = pol1.intersection(pol2).area
-            polygon_union = pol1.union(pol2).area
-            IOU = polygon_intersection / polygon_union
-            if IOU > 0.2:
-                cars[i].has_parking = True   
-                for pol3 in number_plates_boxes_poly:
-                    poly_intersection = pol2.intersection(pol3).area
-                    poly_union = pol2.union(pol3).area
-                    IOU_2 = poly_intersection / poly_union
-                    if IOU_2 > 0.01 and (cars[i].has_parking != hasCar[i]):
-                        x_min, y_min, x_max, y_max = pol3.bounds
-                        if webcam_2:
-                            license_plate_image = imgs[int(y_min):int(y_max), int(x_min):int(x_max)]                            
-                        else:
-                            license_plate_image = imgs[0][int(y_min):int(y_max), int(x_min):int(x_max)]# use webcam
-                        cv2.imwrite(os.path.join("platePic", str(i)+".jpg"), license_plate_image)
+                license_plate_image = imgs[0][int(y_min):int(y_max), int(x_min):int(x_max)]# use webcam
+            if license_plate_image.size:
+                plate_crops.append((i, license_plate_image))  # view into the frame, no copy
+    return plate_crops
 
 def detect(save_img=False):
+    init_slots(load_lot_layout(opt.lot))
+    opt.source = opt.source or lot.source
     source, weights, view_img, save_txt, imgsz, trace = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size, not opt.no_trace
     #save_img = not opt.nosave and not source.endswith('.txt')  # save inference images
     webcam = source.isnumeric() or source.endswith('.txt') or source.lower().startswith(
@@ -141,22 +88,10 @@ def detect(save_img=False):
     
     number_plates_index = 0
     motorcycles_index = 1
-    clear_images_in_folder("platePic")
     #---------samadd----------------
     # Load parked_car_boxes
-    if webcam_2:
-        regions = "weights/new_pkg.p"                    
-    else:
-        regions = "weights/new_pkg.p"     
-    
-    with open(regions, 'rb') as f:
-        parked_car_boxes = pickle.load(f)
-    # Convert to rectangle areas
-    parked_car_boxes_poly = []
-    boxes = convert_to_boxes(parked_car_boxes)
-    for box in boxes:
-        polygon = shape_poly(box)
-        parked_car_boxes_poly.append(polygon)
+    parked_car_polygons = lot.polygons
+    slot_masks = None  # rasterized from the layout polygons at the first frame resolution
 
     #---------samadd----------------
     # Initialize
@@ -164,6 +99,9 @@ def detect(save_img=False):
     device = select_device(opt.device)
     half = device.type != 'cpu'  # half precision only supported on CUDA
 
+    # Convert to rectangle areas, Sx4 xyxy tensor, used with --box-slots
+    parked_car_boxes = torch.tensor(convert_to_boxes(parked_car_polygons), dtype=torch.float32, device=device)
+
     # Load model
     model = attempt_load(weights, map_location=device)  # load FP32 model
     stride = int(model.stride.max())  # model stride
@@ -176,6 +114,12 @@ def detect(save_img=False):
     if half:
         model.half()  # to FP16
 
+    # Load plate model once, reused for every arrival
+    plate_recognizer = PlateRecognizer(opt.plate_weights, device, opt.plate_img_size, opt.plate_conf_thres, opt.iou_thres)
+
+    # Vehicle tracks across frames, plates are read once per track and cached on it
+    tracker = VehicleTracker()
+
     if webcam:
         #view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
@@ -183,6 +127,13 @@ def detect(save_img=False):
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride)
 
+    # Per-stage latency, rolling window of the last frames
+    timer = StageTimer()
+    dataset.timer = timer
+    if opt.timing_port:
+        serve_timing(timer, opt.timing_port)
+    timing_t = time.time()  # last printed timing summary
+
     # Get names and colors
     names = model.module.names if hasattr(model, 'module') else model.names
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
@@ -193,16 +144,50 @@ def detect(save_img=False):
     old_img_w = old_img_h = imgsz
     old_img_b = 1
     
-    sendData()
-
-    t0 = time.time()
-    for path, img, im0s, vid_cap in dataset:
+    # Send data to backend API from a background thread, changes are kept in the outbox until sent
+    outbox = EventOutbox(opt.outbox) if opt.outbox else None
+    sender = TelemetrySender(API_URL, outbox=outbox)
+    sender.submit(recognition_results)
+
+    # Run the detector only when a slot region changed or a keyframe is due, static frames keep the last results
+    gate = MotionGate(convert_to_boxes(parked_car_polygons), opt.gate_thres, keyframe_interval=opt.keyframe_interval) \
+        if opt.gate_thres else None
+
+    # Infer on tiles over the parking slots instead of the whole frame
+    roi = RoiTiles(convert_to_boxes(parked_car_polygons), opt.roi_tiles, imgsz) if opt.roi_tiles else None
+    dataset.letterbox_frames = roi is None  # tiles are cropped from the full frames instead
+
+    # Slots whose plate is still being read, published by the post-processing loop for the preprocess
+    # thread, which must not read cars and tracks while they are being updated
+    reading = frozenset()
+
+    def preprocess(item):
+        # Capture and letterbox run in the dataset iterator, then copy to the device
+        path, img, im0s, vid_cap = item
         t1 = time_synchronized()
+        frames = im0s if webcam else [im0s]
+        if gate:
+            # Keep running while a parked vehicle's plate is being read, its arrival is held back until then
+            run = gate(frames) or bool(reading)
+            timer.lap('gate')
+            if not run:
+                return None  # static frame, dropped before inference
+        if roi:
+            img = roi.crop(frames)
+            timer.lap('roi')
+        frame = dataset.count if webcam else getattr(dataset, 'frame', 0)
         img = torch.from_numpy(img).to(device)
         img = img.half() if half else img.float()  # uint8 to fp16/32
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
         if img.ndimension() == 3:
             img = img.unsqueeze(0)
+        timer.lap('h2d')
+        return path, img, im0s, frame, t1
+
+    @torch.no_grad()  # grad mode is per thread, entered here in the infer stage's thread on every call
+    def infer(item):
+        nonlocal old_img_b, old_img_h, old_img_w
+        path, img, im0s, frame, t1 = item
 
         # Warmup
         if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
@@ -211,23 +196,42 @@ def detect(save_img=False):
             old_img_w = img.shape[3]
             for i in range(3):
                 model(img, augment=opt.augment)[0]
+            timer.lap('warmup')
 
-        # Inference
-        
-        with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
-            pred = model(img, augment=opt.augment)[0]
-        #t2 = time_synchronized()
+        # Inference, calculating gradients would cause a GPU memory leak
+        pred = model(img, augment=opt.augment)[0]
+        timer.lap('forward')
 
         # Apply NMS
         pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
-        #t3 = time_synchronized()
+
+        # Rescale boxes from img_size to the frame size
+        frames = im0s if webcam else [im0s]
+        if roi:
+            pred = roi.merge(pred, frames, opt.iou_thres)
+        else:
+            for det, im0 in zip(pred, frames):
+                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape)
+        for det in pred:
+            det[:, :4] = det[:, :4].round()
+        timer.lap('nms')
+        return path, im0s, frame, t1, pred
+
+    # Pipeline: capture and preprocessing of frame N+1 and post-processing of frame N-1
+    # run on their own threads while frame N is in the model, bounded queues in between
+    preprocessed = PipelineStage('preprocess', preprocess, dataset, maxsize=opt.queue_size, timer=timer)
+    inferred = PipelineStage('infer', infer, preprocessed, maxsize=opt.queue_size, timer=timer)
+
+    t0 = time.time()
+    for path, im0s, frame, t1, pred in inferred:
+        timer.start()  # do not count the wait for the frame
 
         # Process detections
         for i, det in enumerate(pred):  # detections per image
             if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
+                p, s, im0 = path[i], '%g: ' % i, im0s[i].copy()
             else:
-                p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
+                p, s, im0 = path, '', im0s
 
             p = Path(p)  # to Path
             #gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
@@ -236,85 +240,72 @@ def detect(save_img=False):
             
             
             if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
-                
                 for c in det[:, -1].unique():
                     n = (det[:, -1] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
                 
                 #-----get motorcycles & number_plates boxes-----
-                number_plates_boxes = []
-                motorcycles_boxes = []
-                number_plates_boxes_poly = []
-                motorcycles_boxes_poly = []
-                for detection in det:
-                    box_coordinates = detection[:4]
-                    class_index = int(detection[5])
-                    # Classify detected objects by class index
-                    if class_index == number_plates_index:
-                        number_plates_boxes.append(box_coordinates)
-                    elif class_index == motorcycles_index:
-                        motorcycles_boxes.append(box_coordinates)
-
-                number_plates_boxes = [box.tolist() for box in number_plates_boxes]
-                motorcycles_boxes = [box.tolist() for box in motorcycles_boxes]
-
-                for box in number_plates_boxes:
-                    polygon = shape_poly(box)
-                    number_plates_boxes_poly.append(polygon)
-
-                for box in motorcycles_boxes:
-                    polygon = shape_poly(box)
-                    motorcycles_boxes_poly.append(polygon)   
-
+                number_plates_boxes = det[det[:, 5] == number_plates_index, :4]
+                motorcycles_boxes = det[det[:, 5] == motorcycles_index, :4]
                 #-----get motorcycles & number_plates boxes-----
 
-                compute_parking_moto(parked_car_boxes_poly,motorcycles_boxes_poly,number_plates_boxes_poly,cars,im0s)
+                if opt.box_slots:
+                    slots = parked_car_boxes
+                else:
+                    # Slot polygon masks must match the frame resolution
+                    if slot_masks is None or slot_masks.shape != im0.shape[:2]:
+                        slot_masks = SlotMasks(parked_car_polygons, im0.shape)
+                    slots = slot_masks
+                plate_crops = compute_parking_moto(slots,motorcycles_boxes,number_plates_boxes,cars,im0s,tracker)
+                timer.lap('occupancy')
                 
-                if (cars[0].has_parking or cars[1].has_parking or cars[2].has_parking or cars[3].has_parking) and hasCar_changed():
+                # Read the plates of parked vehicles whose track has no plate yet
+                if plate_crops:
                     t3 = time_synchronized()
-                    process = subprocess.Popen(['python', 'detect_rec_plate.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    output, _ = process.communicate()
+                    plates = plate_recognizer.recognize(plate_crops)
                     t4 = time_synchronized()
-                    clear_images_in_folder("platePic")
-                    matches = re.findall(r'\[.*?\]', output.decode(), re.DOTALL)
-                    numIDList = []
-                    # Process matches
-                    for i,match in enumerate(matches):
-                        if i == 0:
-                            numIDList = eval(match)
-                        elif i == 1:
-                            numPlateList = eval(match)
-                        elif i == 2:
-                            colorList = eval(match)   
-
-                    for i in range(len(numIDList)):
-                        cars[numIDList[i]].number_plate = numPlateList[i]
-                        cars[numIDList[i]].color = colorList[i]
-            else:
-                for i in range(4):
-                    cars[i].has_parking = False
-
-            for i in range(4):
-                    if cars[i].has_parking == False:
-                        cars[i].number_plate = "None"
-                        cars[i].color = "None"
+                    timer.lap('ocr')
+                    print(f'----Done. ({(1E3 * (t4 - t3)):.1f}ms) plate----')
 
-            for i, car in enumerate(cars):
+                    for plate in plates:
+                        tracker.add_read(cars[plate.slot].track, plate.number, plate.color)
+            else:
+                tracker.update(torch.zeros((0, 4)))
+                for car in cars:
+                    car.has_parking = False
+                    car.track = None
+                timer.lap('occupancy')
+
+            for car in cars:
+                if car.has_parking == False:
+                    car.number_plate = "None"
+                    car.color = "None"
+                else:  # plate cached on the vehicle's track
+                    car.number_plate = car.track.number
+                    car.color = car.track.color
+
+            reading = frozenset(slot for slot, car in enumerate(cars) if car.has_parking and tracker.needs_read(car.track))
+            for slot, (car, result) in enumerate(zip(cars, recognition_results)):
+                # Hold back an arrival until its plate is final, the API starts a new stay on every plate change
+                if slot in reading:
+                    continue
                 car.number_plate = normalize_license_plate(car.number_plate)
-                print(i,":", car.number_plate, ":", car.color,":", car.has_parking)
-                result = next((item for item in recognition_results if item['ID'] == i + 1), None)
-                if result:
+                print(result['ID'],":", car.number_plate, ":", car.color,":", car.has_parking)
                 # Update recognition results with new data
-                    result['LicensePlateNumber'] = car.number_plate
-                    result['LicensePlateColor'] = car.color
-                    result['IsOccupied'] = car.has_parking
-                #        
-            sendData()
+                result['LicensePlateNumber'] = car.number_plate
+                result['LicensePlateColor'] = car.color
+                result['IsOccupied'] = car.has_parking
+            sender.submit(recognition_results)
             print("-----------sendData-----------")  
             t2 = time_synchronized()
             print(f'----{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) detect----')
+            timer.lap('send')
+        timer.frame()
+
+        # Periodic per-stage latency summary, ms
+        if opt.timing_interval and time.time() - timing_t >= opt.timing_interval:
+            timing_t = time.time()
+            print(f'----timing {json.dumps(timer.summary())}----')
             
     #print(f'Done. ({time.time() - t0:.3f}s)')
     
@@ -323,7 +314,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser() 
     parser.add_argument('--weights', nargs='+', type=str, default='weights/best.pt', help='model.pt path(s)')
     #parser.add_argument('--source', type=str, default='pic/det_plate/1222/moto_2_2.jpg', help='source')  # file/folder, 0 for webcam
-    parser.add_argument('--source', type=str, default='0', help='source')  # file/folder, 0 for webcam
+    parser.add_argument('--source', type=str, default=None, help='source, defaults to the lot layout source')  # file/folder, 0 for webcam
+    parser.add_argument('--lot', type=str, default=LOT_CONFIG, help='lot layout yaml path')
     parser.add_argument('--img-size', type=int, default= 320 , help='inference size (pixels)')#256
     parser.add_argument('--conf-thres', type=float, default=0.6, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
@@ -340,6 +332,17 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='exp', help='save results to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+    parser.add_argument('--outbox', type=str, default='outbox.db', help='offline outbox sqlite path, empty to disable')
+    parser.add_argument('--box-slots', action='store_true', help='use slot bounding boxes instead of polygon masks')
+    parser.add_argument('--plate-weights', nargs='+', type=str, default='weights/yolov7_plate_0421.pt', help='plate model.pt path(s)')
+    parser.add_argument('--plate-img-size', type=int, default=160, help='plate inference size (pixels)')
+    parser.add_argument('--plate-conf-thres', type=float, default=0.7, help='plate character confidence threshold')
+    parser.add_argument('--queue-size', type=int, default=2, help='frames queued between pipeline stages')
+    parser.add_argument('--gate-thres', type=int, default=25, help='gray level change that marks a slot region as changed, 0 to run every frame')
+    parser.add_argument('--keyframe-interval', type=float, default=30, help='max seconds between detector runs on static frames')
+    parser.add_argument('--roi-tiles', type=int, default=0, help='infer on this many tiles over the parking slots, 0 for the whole frame')
+    parser.add_argument('--timing-interval', type=float, default=60, help='seconds between stage latency summaries, 0 to disable')
+    parser.add_argument('--timing-port', type=int, default=0, help='serve stage latencies as JSON on 127.0.0.1:port, 0 to disable')
     opt = parser.parse_args()
     print(opt)
     #check_requirements(exclude=('pycocotools', 'thop'))
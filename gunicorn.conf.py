@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Gunicorn settings, loaded automatically by `gunicorn parking_api:app` from the working directory
+import glob
+import os
+
+# Threaded workers: every request holds a thread while it runs, and so does every open
+# /api/parking/stream for up to STREAM_TIMEOUT. parking_api.py reads GUNICORN_THREADS to size
+# its database pool (DB_POOL_MAX) and to cap the streams so updates always find a free thread
+os.environ.setdefault('GUNICORN_THREADS', '32')
+worker_class = 'gthread'
+threads = int(os.environ['GUNICORN_THREADS'])
+
+
+def on_starting(server):
+    # Prometheus multiprocess mode: drop the metric files of the previous run
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for f in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(f)
+
+
+def child_exit(server, worker):
+    # Prometheus multiprocess mode: forget the live gauges of a worker that exited
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,117 +1,315 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 import threading
 import time
 import json
+import hashlib
 import os
 import sys
+import select
 from datetime import datetime, timedelta
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from contextlib import contextmanager
 import traceback
 
+from utils.lot_layout import load_lot_layout
+from utils.parking_analytics import analytics_range, format_analytics, rollup_sessions
+from utils.parking_metrics import CACHE_REQUESTS, DB_ACQUIRE_SECONDS, DB_POOL_EXHAUSTED, DB_POOL_IN_USE, DB_POOL_SIZE, \
+    DB_QUERY_SECONDS, REQUEST_SECONDS, REQUESTS, UPDATE_SLOTS, metrics_response
+from utils.parking_common import CHANGE_CHANNEL, EVENT_LOCK_ID, SCHEMA_LOCK_ID, SCHEMA_MIGRATIONS, STREAM_KEEPALIVE, \
+    STREAM_TIMEOUT, ChangeBroadcaster, calculate_fee, change_payloads, event_rounds, event_time, \
+    is_valid_update
+
 app = Flask(__name__)
 CORS(app)  # Allow cross-origin requests
 
-# Database connection settings
-def get_db_connection():
-    """Establish database connection"""
+# Parking lot layout (lot.yaml), defines the slot IDs served by this API
+LOT = load_lot_layout()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count requests and their latency per route template, streams until their first byte"""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS.labels(route, request.method, response.status_code).inc()
+    if 'request_start' in g:
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - g.request_start)
+    return response
+
+# Database connection pool settings, one pool per gunicorn worker process
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 1))  # threads per worker, set by gunicorn.conf.py
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', GUNICORN_THREADS + 1))
+DB_PING_INTERVAL = float(os.environ.get('DB_PING_INTERVAL', 30))  # seconds idle before a connection is re-checked
+
+# Open streams per worker, each holds a thread: at most half of them so updates and polls are never starved
+STREAM_MAX = int(os.environ.get('STREAM_MAX', max(1, GUNICORN_THREADS // 2)))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX)
+
+db_pool = None
+db_pool_pid = None
+db_pool_lock = threading.Lock()
+db_last_used = {}  # id(conn) -> last time the connection was returned to the pool
+
+def get_db_pool():
+    """Return the process-wide connection pool, None in memory mode"""
+    global db_pool, db_pool_pid
+    # Render platform provides DATABASE_URL environment variable
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return None
+    if db_pool is None or db_pool_pid != os.getpid():  # pools must not be shared across forked workers
+        with db_pool_lock:
+            if db_pool is None or db_pool_pid != os.getpid():
+                # Cloud environment (Render)
+                print(f"Creating connection pool to cloud database: {database_url[:20]}...") # Only show part of the connection string for security
+                db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, database_url, cursor_factory=RealDictCursor)
+                db_pool_pid = os.getpid()
+                DB_POOL_SIZE.set(DB_POOL_MAX)
+                print(f"✓ Database connection pool ready ({DB_POOL_MIN}-{DB_POOL_MAX} connections)")
+                change_listener_ready.clear()
+                threading.Thread(target=listen_for_changes, args=(database_url,), daemon=True).start()
+    return db_pool
+
+def checkout_connection(pool):
+    """Get a connection from the pool, replacing connections that went stale while idle"""
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if not conn.closed:
+            if time.time() - db_last_used.get(id(conn), 0) < DB_PING_INTERVAL:
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.rollback()
+                return conn
+            except psycopg2.Error:
+                pass
+        db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)  # broken connection, let the pool open a new one
+    raise psycopg2.OperationalError("No healthy database connection available")
+
+class DatabaseUnavailable(Exception):
+    """DATABASE_URL is set but no database connection could be borrowed"""
+
+@contextmanager
+def get_db_connection(memory_fallback=True):
+    """Borrow a database connection from the pool, yields None in memory mode
+
+    When DATABASE_URL is set and the database is unreachable (or the pool is exhausted),
+    falls back to memory mode, or raises DatabaseUnavailable if memory_fallback is False.
+    Writes must not fall back: they would be acknowledged but never stored.
+
+    Usage:
+        with get_db_connection() as conn:
+            if conn: ...
+    """
+    conn = pool = None
     try:
-        # Render platform provides DATABASE_URL environment variable
-        database_url = os.environ.get('DATABASE_URL')
-        if database_url:
-            # Cloud environment (Render)
-            print(f"Trying to connect to cloud database: {database_url[:20]}...") # Only show part of the connection string for security
-            conn = psycopg2.connect(database_url, cursor_factory=RealDictCursor)
-            print("✓ Database connection successful")
-            return conn
+        pool = get_db_pool()
+        if pool:
+            with DB_ACQUIRE_SECONDS.time():
+                conn = checkout_connection(pool)
         else:
             # Local development using memory mode
             print("DATABASE_URL environment variable not found, using memory mode")
-            return None
     except Exception as e:
+        if isinstance(e, PoolError):
+            DB_POOL_EXHAUSTED.inc()
         print(f"✗ Database connection failed: {e}")
+        if not memory_fallback:
+            raise DatabaseUnavailable(str(e)) from e
         print("Using memory mode as backup")
-        return None
+
+    if conn is None:
+        yield None
+        return
+    DB_POOL_IN_USE.inc()
+    try:
+        yield conn
+    finally:
+        DB_POOL_IN_USE.dec()
+        # Never return a connection with an open transaction to the pool
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed:
+            db_last_used.pop(id(conn), None)
+        else:
+            db_last_used[id(conn)] = time.time()
+        pool.putconn(conn, close=bool(conn.closed))
+
+# Cached lot state (status snapshot, plate index) is tagged with cache_generation, which is bumped
+# whenever a parking space changes. Updates NOTIFY the other gunicorn workers through Postgres.
+cache_generation = 0
+cache_generation_lock = threading.Lock()
+change_listener_ready = threading.Event()  # set while this process is LISTENing for changes
+
+broadcaster = ChangeBroadcaster()
+
+def invalidate_caches():
+    """Mark the cached lot state of this process as stale"""
+    global cache_generation
+    with cache_generation_lock:
+        cache_generation += 1
+
+def listen_for_changes(database_url):
+    """Background thread, invalidates the caches whenever any worker notifies a change"""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(database_url)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANGE_CHANNEL};")
+                # Changes may have been missed while not listening
+                cursor.execute("SELECT to_regclass('parking_event_seq') IS NOT NULL;")
+                if cursor.fetchone()[0]:
+                    cursor.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM parking_event_seq;")
+                    broadcaster.reset(cursor.fetchone()[0])
+            invalidate_caches()
+            change_listener_ready.set()
+            while True:
+                if select.select([conn], [], [], DB_PING_INTERVAL) == ([], [], []):
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1;")  # idle, make sure the connection is still alive
+                conn.poll()
+                if conn.notifies:
+                    notifies = conn.notifies[:]
+                    conn.notifies.clear()
+                    invalidate_caches()
+                    for notify in notifies:
+                        if notify.payload:
+                            broadcaster.publish(json.loads(notify.payload))
+        except Exception as e:
+            change_listener_ready.clear()
+            print(f"✗ Change listener failed: {e}, retrying")
+            if conn:
+                conn.close()
+            time.sleep(5)
+
+def notify_change(cursor, spaces):
+    """Tell every worker which parking spaces changed, delivered when the transaction commits"""
+    for payload in change_payloads(spaces):
+        cursor.execute("SELECT pg_notify(%s, %s);", (CHANGE_CHANNEL, payload))
+
+def cache_is_fresh(generation):
+    """Cached lot state tagged with generation can be served without a database query"""
+    return generation == cache_generation and (get_db_pool() is None or change_listener_ready.is_set())
 
 # Memory data structure (for local development)
 parking_data = {}
+parking_sessions = []  # finished parking sessions, parking_sessions table in memory mode
+
+def migrate_database(conn):
+    """Apply pending schema migrations, returns the current schema version"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_LOCK_ID,))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations;")
+    version = cursor.fetchone()['version']
+    for migration_version, sql in SCHEMA_MIGRATIONS:
+        if migration_version > version:
+            print(f"Applying schema migration {migration_version}")
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s);", (migration_version,))
+            version = migration_version
+    conn.commit()
+    cursor.close()
+    return version
 
 def init_database():
-    """Initialize database tables"""
-    conn = get_db_connection()    
-    if not conn:
-        print("Using memory mode")
-        # Initialize memory data
-        global parking_data
-        for i in range(1, 5):
-            parking_data[i] = {
-                'id': i,
-                'is_occupied': False,
-                'plate_number': None,
-                'plate_color': None,
-                'started_at': None
-            }
-        return
+    """Initialize database tables, runs once at startup so request handlers only query"""
+    with get_db_connection() as conn:
+        if not conn:
+            print("Using memory mode")
+            # Initialize memory data
+            for i in LOT.slot_ids:
+                parking_data[i] = {
+                    'id': i,
+                    'is_occupied': False,
+                    'plate_number': None,
+                    'plate_color': None,
+                    'started_at': None
+                }
+            return
     
-    try:
-        cursor = conn.cursor()
-        # Create parking spaces table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS parking_spaces (
-                id INTEGER PRIMARY KEY,
-                is_occupied BOOLEAN DEFAULT FALSE,
-                license_plate_number VARCHAR(20),
-                license_plate_color VARCHAR(20),
-                parking_time TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        
-        # Default create 4 parking spaces
-        for i in range(1, 5):
-            cursor.execute("""
+        try:
+            version = migrate_database(conn)
+
+            # Create one row per parking space of the lot layout
+            cursor = conn.cursor()
+            execute_values(cursor, """
                 INSERT INTO parking_spaces (id, is_occupied, license_plate_number, license_plate_color) 
-                VALUES (%s, %s, %s, %s) 
+                VALUES %s 
                 ON CONFLICT (id) DO NOTHING;
-            """, (i, False, None, None))
+            """, [(i, False, None, None) for i in LOT.slot_ids])
         
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("✓ Database initialization complete")
-    except Exception as e:
-        print(f"✗ Database initialization failed: {e}")
-        print(f"Error details: {traceback.format_exc()}")
-        print("Using memory mode as backup")
+            conn.commit()
+            cursor.close()
+            print(f"✓ Database initialization complete (schema version {version})")
+        except Exception as e:
+            print(f"✗ Database initialization failed: {e}")
+            print(f"Error details: {traceback.format_exc()}")
+            print("Using memory mode as backup")
 
 # Initialize database on application startup
 init_database()
 
-def calculate_fee(start_time, plate_color=None):
-    """Calculate parking fee based on plate color
-    White plate: 1 per 10 seconds 
-    Red/Yellow plate: 2 per 10 seconds 
-    """
-    if not start_time:
-        return 0
-    
-    current_time = datetime.now() - timedelta(hours=4)
-    if isinstance(start_time, str):
-        start_time = datetime.fromisoformat(start_time.replace('T', ' '))
-    
-    duration = current_time - start_time
-    duration_seconds = int(duration.total_seconds())
-    
-    # Calculate fee based on plate color
-    if plate_color and (plate_color.lower() == 'red' or plate_color.lower() == 'yellow'):
-        # Red/Yellow plate: 2 per 10 seconds
-        return (duration_seconds // 10) * 2
+# In-process license plate -> slot ID index of occupied parking spaces, kept by the update path
+# so /api/parking/my_status answers plates that are not parked without a database query
+PLATE_INDEX_TTL = float(os.environ.get('PLATE_INDEX_TTL', 5))  # seconds, reload interval while change notifications are down
+plate_index = {}
+plate_index_loaded = 0
+plate_index_generation = -1
+plate_index_lock = threading.Lock()
+
+# Snapshot of GET /api/parking/status, (cache generation, JSON body, ETag)
+status_cache = None
+
+def index_plates(spaces):
+    """Apply changed parking spaces, (id, is_occupied, plate_number) tuples, to the plate index"""
+    with plate_index_lock:
+        for space_id, is_occupied, plate_number in spaces:
+            for plate in [plate for plate, i in plate_index.items() if i == space_id]:
+                del plate_index[plate]
+            if is_occupied and plate_number:
+                plate_index[plate_number] = space_id
+
+def lookup_plate(conn, plate):
+    """Slot ID of the parking space occupied by a license plate, None if not parked"""
+    global plate_index_loaded, plate_index_generation
+    if conn and not cache_is_fresh(plate_index_generation) and \
+            (change_listener_ready.is_set() or time.time() - plate_index_loaded > PLATE_INDEX_TTL):
+        # Reload from the database, the other gunicorn workers update it too
+        CACHE_REQUESTS.labels('plate_index', 'miss').inc()
+        generation = cache_generation
+        cursor = conn.cursor()
+        with DB_QUERY_SECONDS.labels('plate_index').time():
+            cursor.execute("SELECT id, license_plate_number FROM parking_spaces WHERE is_occupied AND license_plate_number IS NOT NULL;")
+            spaces = cursor.fetchall()
+        cursor.close()
+        with plate_index_lock:
+            plate_index.clear()
+            plate_index.update({space['license_plate_number']: space['id'] for space in spaces})
+            plate_index_loaded = time.time()
+            plate_index_generation = generation
     else:
-        # White plate (default): 1 per 10 seconds
-        return duration_seconds // 10
+        CACHE_REQUESTS.labels('plate_index', 'hit').inc()
+    return plate_index.get(plate)
 
 @app.route('/', methods=['GET'])
 def home():
@@ -122,7 +320,9 @@ def home():
         'endpoints': [
             'POST /api/parking/update - Update parking space status',
             'GET /api/parking/status - Query all parking spaces',
-            'GET /api/parking/my_status?plate=LICENSE - Query individual parking status'
+            'GET /api/parking/my_status?plate=LICENSE - Query individual parking status',
+            'GET /api/parking/stream - Server-Sent Events of parking space changes',
+            'GET /api/parking/analytics?from=&to=&bucket=hour|day - Occupancy, turnover and dwell per slot'
         ],
         'status': 'running',
         'current_time': (datetime.now() - timedelta(hours=4)).isoformat(),
@@ -131,166 +331,226 @@ def home():
 
 @app.route('/api/parking/update', methods=['POST'])
 def update_parking_status():
-    """Receive parking space status from Raspberry Pi, update DB only on change"""
+    """Receive parking space status from Raspberry Pi, update DB only on change
+
+    The payload may hold every parking space or only the ones that changed.
+    Each space may carry an edge-side ISO 8601 'Timestamp', used as the parking and
+    exit time so events replayed from the edge outbox keep their original time.
+    Several events of one space are applied in order, see event_rounds().
+    """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
 
-        if not data or not isinstance(data, list) or len(data) != 4:
+        if not is_valid_update(data, LOT.index):
             return jsonify({
                 'success': False,
-                'error': 'Invalid data format, must include 4 parking spaces'
+                'error': f'Invalid data format, must be a list of parking spaces with IDs in {LOT.slot_ids}'
             }), 400
 
         current_time = datetime.now() - timedelta(hours=4)
-        conn = get_db_connection()
-        
-        if conn:
-            # Using database
-            cursor = conn.cursor()
+        # The payload may replay several outbox events of one space, applied in order
+        rounds = event_rounds(data)
+        spaces = {space.get('ID') for space in data}
 
-            for space in data:
-                space_id = space.get('ID')
-                is_occupied = space.get('IsOccupied', False)
-                plate_number = space.get('LicensePlateNumber') or None
-                plate_color = space.get('LicensePlateColor') or None
-
-                # 先抓目前資料，確認是否真的變動
-                cursor.execute("SELECT is_occupied, license_plate_number FROM parking_spaces WHERE id = %s", (space_id,))
-                existing = cursor.fetchone()
-
-                if existing and existing['is_occupied'] == is_occupied and existing['license_plate_number'] == plate_number:
-                    continue  # 無變動，跳過寫入
-
-                # 計算進入時間（僅在進入時紀錄）
-                parking_time = current_time if is_occupied else None
-
-                # UPSERT
-                cursor.execute("""
-                    INSERT INTO parking_spaces (id, is_occupied, license_plate_number, license_plate_color, parking_time, updated_at)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (id) DO UPDATE SET
-                        is_occupied = EXCLUDED.is_occupied,
-                        license_plate_number = EXCLUDED.license_plate_number,
-                        license_plate_color = EXCLUDED.license_plate_color,
-                        parking_time = EXCLUDED.parking_time,
-                        updated_at = EXCLUDED.updated_at;
-                """, (space_id, is_occupied, plate_number, plate_color, parking_time, current_time))
+        with get_db_connection(memory_fallback=False) as conn:
+        
+            if conn:
+                # Using database, one statement per round of events
+                cursor = conn.cursor()
+                query_start = time.perf_counter()
+                cursor.execute("SELECT pg_advisory_xact_lock(%s);", (EVENT_LOCK_ID,))
+                changed = []
+                for events in rounds:
+                    rows = []
+                    for space in events:
+                        is_occupied = space.get('IsOccupied', False)
+                        plate_number = space.get('LicensePlateNumber') or None
+                        plate_color = space.get('LicensePlateColor') or None
+                        # 以邊緣端事件時間為準，計算進入時間（僅在進入時紀錄）與離開時間
+                        updated_at = event_time(space, current_time)
+                        parking_time = updated_at if is_occupied else None
+                        rows.append((space.get('ID'), is_occupied, plate_number, plate_color, parking_time, updated_at))
+
+                    # UPSERT，WHERE 條件跳過無變動的車位，RETURNING 回傳真正變動的車位
+                    changed += execute_values(cursor, """
+                    WITH v (id, is_occupied, license_plate_number, license_plate_color, parking_time, updated_at) AS (
+                        VALUES %s
+                    ),
+                    prev AS (
+                        SELECT s.* FROM parking_spaces s JOIN v ON s.id = v.id
+                    ),
+                    changed AS (
+                        INSERT INTO parking_spaces AS p (id, is_occupied, license_plate_number, license_plate_color, parking_time, updated_at)
+                        SELECT * FROM v
+                        ON CONFLICT (id) DO UPDATE SET
+                            is_occupied = EXCLUDED.is_occupied,
+                            license_plate_number = EXCLUDED.license_plate_number,
+                            license_plate_color = EXCLUDED.license_plate_color,
+                            parking_time = EXCLUDED.parking_time,
+                            updated_at = EXCLUDED.updated_at
+                        WHERE (p.is_occupied, p.license_plate_number) IS DISTINCT FROM (EXCLUDED.is_occupied, EXCLUDED.license_plate_number)
+                        RETURNING p.id, p.is_occupied, p.license_plate_number, p.license_plate_color, p.updated_at,
+                                  nextval('parking_event_seq') AS event_id
+                    ),
+                    -- 離開或換車時，將上一段停車紀錄寫入 parking_sessions
+                    closed AS (
+                        INSERT INTO parking_sessions (slot_id, license_plate_number, license_plate_color, entered_at, exited_at, fee)
+                        SELECT prev.id, prev.license_plate_number, prev.license_plate_color, prev.parking_time,
+                               GREATEST(changed.updated_at, prev.parking_time) AS exited_at,
+                               parking_fee(prev.parking_time, GREATEST(changed.updated_at, prev.parking_time), prev.license_plate_color)
+                        FROM prev JOIN changed ON prev.id = changed.id
+                        WHERE prev.is_occupied AND prev.parking_time IS NOT NULL
+                    )
+                    SELECT id, is_occupied, license_plate_number, license_plate_color, event_id FROM changed ORDER BY event_id;
+                    """, rows, template="(%s, %s, %s, %s, %s::timestamp, %s::timestamp)", page_size=len(rows), fetch=True)
+                notify_change(cursor, changed)
 
-            conn.commit()
-            cursor.close()
-            conn.close()
-        else:
-            # Using memory mode (local development)
-            global parking_data
-            for space in data:
-                space_id = space.get('ID')
-                is_occupied = space.get('IsOccupied', False)
-                plate_number = space.get('LicensePlateNumber') or None
-                plate_color = space.get('LicensePlateColor') or None
-
-                # Initialize space if not exists
-                if space_id not in parking_data:
-                    parking_data[space_id] = {
-                        'id': space_id,
-                        'is_occupied': False,
-                        'plate_number': None,
-                        'plate_color': None,
-                        'started_at': None
-                    }
-
-                # Check if status changed
-                if parking_data[space_id]['is_occupied'] == is_occupied and parking_data[space_id]['plate_number'] == plate_number:
-                    continue  # No change, skip
-
-                # Update parking data
-                parking_data[space_id]['is_occupied'] = is_occupied
-                parking_data[space_id]['plate_number'] = plate_number
-                parking_data[space_id]['plate_color'] = plate_color
-                parking_data[space_id]['started_at'] = current_time if is_occupied else None
+                conn.commit()
+                DB_QUERY_SECONDS.labels('update').observe(time.perf_counter() - query_start)
+                cursor.close()
+                index_plates((row['id'], row['is_occupied'], row['license_plate_number']) for row in changed)
+                changed = list({row['id'] for row in changed})
+            else:
+                # Using memory mode (local development)
+                changed = []
+                for space in (space for events in rounds for space in events):
+                    space_id = space.get('ID')
+                    is_occupied = space.get('IsOccupied', False)
+                    plate_number = space.get('LicensePlateNumber') or None
+                    plate_color = space.get('LicensePlateColor') or None
+
+                    # Initialize space if not exists
+                    if space_id not in parking_data:
+                        parking_data[space_id] = {
+                            'id': space_id,
+                            'is_occupied': False,
+                            'plate_number': None,
+                            'plate_color': None,
+                            'started_at': None
+                        }
+
+                    # Check if status changed
+                    if parking_data[space_id]['is_occupied'] == is_occupied and parking_data[space_id]['plate_number'] == plate_number:
+                        continue  # No change, skip
+
+                    # Record the session that just ended, at the edge-side event time
+                    prev = parking_data[space_id]
+                    updated_at = event_time(space, current_time)
+                    if prev['is_occupied'] and prev['started_at']:
+                        exited_at = max(updated_at, prev['started_at'])
+                        parking_sessions.append({
+                            'slot_id': space_id,
+                            'plate_number': prev['plate_number'],
+                            'plate_color': prev['plate_color'],
+                            'entered_at': prev['started_at'],
+                            'exited_at': exited_at,
+                            'fee': calculate_fee(prev['started_at'], prev['plate_color'], exited_at)
+                        })
 
-        return jsonify({
-            'success': True,
-            'message': 'DB updated only on status change',
-            'timestamp': current_time.isoformat()
-        })
+                    # Update parking data
+                    parking_data[space_id]['is_occupied'] = is_occupied
+                    parking_data[space_id]['plate_number'] = plate_number
+                    parking_data[space_id]['plate_color'] = plate_color
+                    parking_data[space_id]['started_at'] = updated_at if is_occupied else None
+                    if space_id not in changed:
+                        changed.append(space_id)
+                index_plates((i, parking_data[i]['is_occupied'], parking_data[i]['plate_number']) for i in changed)
+                broadcaster.publish({
+                    'id': i,
+                    'is_occupied': parking_data[i]['is_occupied'],
+                    'plate_number': parking_data[i]['plate_number'],
+                    'plate_color': parking_data[i]['plate_color']
+                } for i in sorted(changed))
+            if changed:
+                invalidate_caches()
+            UPDATE_SLOTS.labels('changed').inc(len(changed))
+            UPDATE_SLOTS.labels('unchanged').inc(len(spaces) - len(changed))
 
+            return jsonify({
+                'success': True,
+                'message': 'DB updated only on status change',
+                'changed': sorted(changed),
+                'timestamp': current_time.isoformat()
+            })
+
+    except DatabaseUnavailable as e:
+        # The edge keeps its events and retries, nothing was stored
+        return jsonify({'success': False, 'error': f'Database unavailable: {e}'}), 503, {'Retry-After': '5'}
     except Exception as e:
         print(f"✗ Error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def status_snapshot():
+    """JSON body and ETag of all parking spaces, rebuilt only after a parking space changes"""
+    global status_cache
+    cached = status_cache
+    if cached and cache_is_fresh(cached[0]):
+        CACHE_REQUESTS.labels('status', 'hit').inc()
+        body, etag = cached[1:]
+    else:
+        CACHE_REQUESTS.labels('status', 'miss').inc()
+        generation = cache_generation
+        with get_db_connection() as conn:
+        
+            if conn:
+                # Using database
+                try:
+                    cursor = conn.cursor()
+                    with DB_QUERY_SECONDS.labels('status').time():
+                        cursor.execute("SELECT * FROM parking_spaces ORDER BY id;")
+                        spaces = cursor.fetchall()
+                    cursor.close()
+                    result = []
+                    for space in spaces:
+                        result.append({
+                            'id': space['id'],
+                            'is_occupied': space['is_occupied'],
+                            'plate_number': space['license_plate_number'],
+                            'plate_color': space['license_plate_color']
+                        })
+                except Exception as e:
+                    print(f"✗ Database query failed: {e}")
+                    print(f"Error details: {traceback.format_exc()}")
+                    raise e
+            else:
+                # Using memory mode (local development)
+                result = []
+                for space_id in LOT.slot_ids:
+                    if space_id in parking_data and parking_data[space_id]['is_occupied']:
+                        result.append({
+                            'id': space_id,
+                            'is_occupied': True,
+                            'plate_number': parking_data[space_id]['plate_number'],
+                            'plate_color': parking_data[space_id].get('plate_color', 'None')
+                        })
+                    else:
+                        result.append({
+                            'id': space_id,
+                            'is_occupied': False,
+                            'plate_number': None,
+                            'plate_color': None
+                        })
+
+        body = jsonify(result).get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        status_cache = (generation, body, etag)
+    return body, etag
+
 @app.route('/api/parking/status', methods=['GET'])
 def get_parking_status():
-    """Query all parking spaces"""
+    """Query all parking spaces
+
+    Served from an in-memory snapshot until a parking space changes, with a strong
+    ETag so clients polling with If-None-Match get 304 Not Modified.
+    """
     try:
-        conn = get_db_connection()
-        
-        if conn:
-            # Using database
-            try:
-                cursor = conn.cursor()
-                
-                # Ensure table exists
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS parking_spaces (
-                        id INTEGER PRIMARY KEY,
-                        is_occupied BOOLEAN DEFAULT FALSE,
-                        license_plate_number VARCHAR(20),
-                        license_plate_color VARCHAR(20),
-                        parking_time TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-                
-                # Default create 4 parking spaces
-                for i in range(1, 5):
-                    cursor.execute("""
-                        INSERT INTO parking_spaces (id, is_occupied, license_plate_number, license_plate_color) 
-                        VALUES (%s, %s, %s, %s) 
-                        ON CONFLICT (id) DO NOTHING;
-                    """, (i, False, None, None))
-                
-                conn.commit()
-                
-                cursor.execute("SELECT * FROM parking_spaces ORDER BY id;")
-                spaces = cursor.fetchall()
-                cursor.close()
-                conn.close()
-                result = []
-                for space in spaces:
-                    result.append({
-                        'id': space['id'],
-                        'is_occupied': space['is_occupied'],
-                        'plate_number': space['license_plate_number'],
-                        'plate_color': space['license_plate_color']
-                    })
-                return jsonify(result)
-            except Exception as e:
-                print(f"✗ Database query failed: {e}")
-                print(f"Error details: {traceback.format_exc()}")
-                conn.close()
-                raise e
-        else:
-            # Using memory mode (local development)
-            result = []
-            for space_id in range(1, 5):
-                if space_id in parking_data and parking_data[space_id]['is_occupied']:
-                    result.append({
-                        'id': space_id,
-                        'is_occupied': True,
-                        'plate_number': parking_data[space_id]['plate_number'],
-                        'plate_color': parking_data[space_id].get('plate_color', 'None')
-                    })
-                else:
-                    result.append({
-                        'id': space_id,
-                        'is_occupied': False,
-                        'plate_number': None,
-                        'plate_color': None
-                    })
-            return jsonify(result)
-        
+        body, etag = status_snapshot()
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'  # clients revalidate with If-None-Match
+        return response.make_conditional(request)
+
     except Exception as e:
         print(f"✗ Error processing query request: {e}")
         print(f"Error details: {traceback.format_exc()}")
@@ -311,71 +571,59 @@ def get_my_parking_status():
                 'error': 'License plate number is required'
             }), 400
         
-        conn = get_db_connection()
+        with get_db_connection() as conn:
         
-        if conn:
-            # Using database
-            try:
-                cursor = conn.cursor()
-                
-                # Ensure table exists
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS parking_spaces (
-                        id INTEGER PRIMARY KEY,
-                        is_occupied BOOLEAN DEFAULT FALSE,
-                        license_plate_number VARCHAR(20),
-                        license_plate_color VARCHAR(20),
-                        parking_time TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-                conn.commit()
+            if conn:
+                # Using database
+                try:
+                    space = None
+                    if lookup_plate(conn, plate) is not None:
+                        # Uses the partial plate index, the slot may have changed since the plate index was loaded
+                        cursor = conn.cursor()
+                        with DB_QUERY_SECONDS.labels('my_status').time():
+                            cursor.execute("SELECT * FROM parking_spaces WHERE license_plate_number = %s AND is_occupied;", (plate,))
+                            space = cursor.fetchone()
+                        cursor.close()
                 
-                cursor.execute("SELECT * FROM parking_spaces WHERE license_plate_number = %s;", (plate,))
-                space = cursor.fetchone()
-                cursor.close()
-                conn.close()
-                
-                if space and space['is_occupied']:
-                    start_time = space['parking_time']
-                    if start_time:
-                        current_time = datetime.now() - timedelta(hours=4)
+                    if space and space['is_occupied']:
+                        start_time = space['parking_time']
+                        if start_time:
+                            current_time = datetime.now() - timedelta(hours=4)
                         
-                        # Calculate parking duration
-                        duration = current_time - start_time
-                        duration_minutes = int(duration.total_seconds() / 60)
+                            # Calculate parking duration
+                            duration = current_time - start_time
+                            duration_minutes = int(duration.total_seconds() / 60)
                         
-                        # Calculate parking fee
-                        fee = calculate_fee(start_time, space['license_plate_color'])
-                        return jsonify({
-                            'is_parked': True,
-                            'parking_slot': space['id'],
-                            'license_plate_number': space['license_plate_number'],
-                            'license_plate_color': space['license_plate_color'],
-                            'started_at': start_time.strftime('%Y-%m-%d %H:%M:%S'),
-                            'duration_minutes': duration_minutes,
-                            'fee': fee
-                        })
-            except Exception as e:
-                print(f"✗ Database query failed: {e}")
-                print(f"Error details: {traceback.format_exc()}")
-                conn.close()
-                raise e
-        else:
-            # Using memory mode (local development)
-            for space_id, space in parking_data.items():
-                if space['is_occupied'] and space['plate_number'] == plate:
+                            # Calculate parking fee
+                            fee = calculate_fee(start_time, space['license_plate_color'])
+                            return jsonify({
+                                'is_parked': True,
+                                'parking_slot': space['id'],
+                                'license_plate_number': space['license_plate_number'],
+                                'license_plate_color': space['license_plate_color'],
+                                'started_at': start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'duration_minutes': duration_minutes,
+                                'fee': fee
+                            })
+                except Exception as e:
+                    print(f"✗ Database query failed: {e}")
+                    print(f"Error details: {traceback.format_exc()}")
+                    raise e
+            else:
+                # Using memory mode (local development)
+                space_id = lookup_plate(None, plate)
+                if space_id is not None:
+                    space = parking_data[space_id]
                     start_time = space['started_at']
                     current_time = datetime.now() - timedelta(hours=4)
-                    
+                
                     # Calculate parking duration
                     duration = current_time - start_time
                     duration_minutes = int(duration.total_seconds() / 60)
-                    
+                
                     # Calculate parking fee
                     fee = calculate_fee(start_time, space['plate_color'])
-                    
+                
                     return jsonify({
                         'is_parked': True,
                         'parking_slot': space_id,
@@ -384,11 +632,11 @@ def get_my_parking_status():
                         'fee': fee
                     })
         
-        # Parking space not occupied
-        return jsonify({
-            'is_parked': False,
-            'message': 'No parking space occupied by this license plate'
-        })
+            # Parking space not occupied
+            return jsonify({
+                'is_parked': False,
+                'message': 'No parking space occupied by this license plate'
+            })
         
     except Exception as e:
         print(f"✗ Error processing query request: {e}")
@@ -398,16 +646,108 @@ def get_my_parking_status():
             'error': f'Query failed: {str(e)}'
         }), 500
 
+@app.route('/api/parking/stream', methods=['GET'])
+def stream_parking_status():
+    """Server-Sent Events stream of parking space changes
+
+    Starts with a 'snapshot' event holding all parking spaces, then sends one 'slot'
+    event per changed parking space. Reconnecting clients send Last-Event-ID (or
+    ?last_event_id=) and only receive the events they missed. Each open stream holds
+    a worker thread, so at most STREAM_MAX streams are open per worker, 503 beyond that.
+    """
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({
+            'success': False,
+            'error': 'Too many open streams, retry later'
+        }), 503, {'Retry-After': '30'}
+
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+
+    def generate():
+        nonlocal last_id
+        yield "retry: 3000\n\n"
+        deadline = time.time() + STREAM_TIMEOUT
+        while time.time() < deadline:
+            events = broadcaster.since(last_id)
+            if events is None:
+                # New client or too far behind, send the whole lot
+                last_id = broadcaster.last_id
+                body, _ = status_snapshot()
+                yield f"id: {last_id}\nevent: snapshot\ndata: {body.decode()}\n\n"
+                continue
+            for event_id, frame in events:
+                yield frame
+                last_id = event_id
+            if not events and not broadcaster.wait(last_id, min(STREAM_KEEPALIVE, deadline - time.time())):
+                yield ": keep-alive\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stream_slots.release)
+    return response
+
+@app.route('/api/parking/analytics', methods=['GET'])
+def get_parking_analytics():
+    """Occupancy rate, turnover and average dwell per slot per hour or day
+
+    Query: from, to (ISO 8601, default the last day or 30 days), bucket (hour or day).
+    Read from the hourly rollups maintained by the parking_sessions trigger.
+    """
+    try:
+        current_time = datetime.now() - timedelta(hours=4)
+        try:
+            start, end, bucket = analytics_range(request.args, current_time)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        with get_db_connection() as conn:
+            if conn:
+                # Using database
+                cursor = conn.cursor()
+                with DB_QUERY_SECONDS.labels('analytics').time():
+                    cursor.execute("SELECT * FROM parking_occupancy(%s, %s, %s, %s);", (start, end, bucket, current_time))
+                    rows = cursor.fetchall()
+                cursor.close()
+            else:
+                # Using memory mode (local development), finished and ongoing sessions
+                sessions = parking_sessions + [
+                    {'slot_id': space_id, 'entered_at': space['started_at'], 'exited_at': None}
+                    for space_id, space in parking_data.items() if space['is_occupied'] and space['started_at']]
+                rows = rollup_sessions(sessions, start, end, bucket, current_time)
+
+        return jsonify({
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'bucket': bucket,
+            'data': format_analytics(rows, bucket)
+        })
+
+    except Exception as e:
+        print(f"✗ Error processing analytics request: {e}")
+        print(f"Error details: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'error': f'Query failed: {str(e)}'
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, merged across gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint, for Render platform to check database connection"""
     try:
-        # Check database connection
-        conn = get_db_connection()
-        db_status = "connected" if conn else "disconnected"
-        if conn:
-            conn.close()
+        # Check database connection, borrowed from the pool and re-checked if idle
+        with get_db_connection() as conn:
+            db_status = "connected" if conn else "disconnected"
         
         return jsonify({
             'status': 'healthy',
@@ -424,39 +764,47 @@ def health_check():
     
 @app.route('/api/reset', methods=['POST'])
 def reset_parking_data():
-    """Reset parking_spaces table: truncate + insert 4 initial spaces"""
+    """Reset parking_spaces table: truncate + insert the lot layout spaces"""
     try:
         # 安全驗證（避免被公開觸發）
         secret = request.json.get('secret_key')
         if secret != os.environ.get("RESET_SECRET", "my_dev_key"):
             return jsonify({'success': False, 'error': 'Unauthorized'}), 403
 
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'success': False, 'error': 'DB connection failed'}), 500
+        with get_db_connection(memory_fallback=False) as conn:
+            if not conn:
+                return jsonify({'success': False, 'error': 'DB connection failed'}), 500
 
-        cursor = conn.cursor()
+            cursor = conn.cursor()
 
-        # 清空資料表
-        cursor.execute("TRUNCATE TABLE parking_spaces RESTART IDENTITY;")
+            # 清空資料表
+            query_start = time.perf_counter()
+            cursor.execute("TRUNCATE TABLE parking_spaces RESTART IDENTITY;")
 
-        # 初始化四筆資料
-        for i in range(1, 5):
-            cursor.execute("""
+            # 依車位配置初始化資料
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (EVENT_LOCK_ID,))
+            spaces = execute_values(cursor, """
                 INSERT INTO parking_spaces (id, is_occupied, license_plate_number, license_plate_color)
-                VALUES (%s, FALSE, NULL, NULL)
-            """, (i,))
+                VALUES %s
+                RETURNING id, is_occupied, license_plate_number, license_plate_color,
+                          nextval('parking_event_seq') AS event_id;
+            """, [(i, False, None, None) for i in LOT.slot_ids], page_size=len(LOT.slot_ids), fetch=True)
+            notify_change(cursor, spaces)
 
-        conn.commit()
-        cursor.close()
-        conn.close()
+            conn.commit()
+            DB_QUERY_SECONDS.labels('reset').observe(time.perf_counter() - query_start)
+            cursor.close()
+            index_plates((i, False, None) for i in LOT.slot_ids)
+            invalidate_caches()
 
-        return jsonify({
-            'success': True,
-            'message': 'Database has been reset.',
-            'reset_at': (datetime.now() - timedelta(hours=4)).isoformat()
-        })
+            return jsonify({
+                'success': True,
+                'message': 'Database has been reset.',
+                'reset_at': (datetime.now() - timedelta(hours=4)).isoformat()
+            })
 
+    except DatabaseUnavailable as e:
+        return jsonify({'success': False, 'error': f'Database unavailable: {e}'}), 503, {'Retry-After': '5'}
     except Exception as e:
         print(f"✗ Reset error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -476,9 +824,14 @@ def internal_error(error):
     }), 500
 
 if __name__ == '__main__':
-    # Initialize database
-    init_database()
-    
+    # `python parking_api.py migrate` only applies schema migrations and exits
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        with get_db_connection() as conn:
+            if not conn:
+                sys.exit("✗ DATABASE_URL is required to migrate")
+            print(f"✓ Schema version {migrate_database(conn)}")
+        sys.exit(0)
+
     # For local development
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+# Async (ASGI) variant of parking_api.py: same endpoints and payloads, served from an asyncpg pool
+# so one process holds thousands of pollers and streaming clients. Requires DATABASE_URL.
+#   hypercorn parking_api_async:app --bind 0.0.0.0:$PORT
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import asyncpg
+from quart import Quart, Response, g, jsonify, request
+from quart_cors import cors
+
+from utils.lot_layout import load_lot_layout
+from utils.parking_analytics import analytics_range, format_analytics
+from utils.parking_metrics import CACHE_REQUESTS, DB_POOL_IN_USE, DB_POOL_SIZE, DB_QUERY_SECONDS, REQUEST_SECONDS, \
+    REQUESTS, UPDATE_SLOTS, metrics_response
+from utils.parking_common import CHANGE_CHANNEL, EVENT_LOCK_ID, SCHEMA_LOCK_ID, SCHEMA_MIGRATIONS, STREAM_KEEPALIVE, \
+    STREAM_TIMEOUT, ChangeBroadcaster, calculate_fee, change_payloads, event_rounds, event_time, \
+    is_valid_update
+
+app = Quart(__name__)
+app = cors(app, allow_origin='*')  # Allow cross-origin requests
+
+# Parking lot layout (lot.yaml), defines the slot IDs served by this API
+LOT = load_lot_layout()
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+async def record_request_metrics(response):
+    """Count requests and their latency per route template, streams until their first byte"""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS.labels(route, request.method, response.status_code).inc()
+    if 'request_start' in g:
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - g.request_start)
+    return response
+
+# Database connection pool settings, one pool per process
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_PING_INTERVAL = float(os.environ.get('DB_PING_INTERVAL', 30))  # seconds between change listener health checks
+PLATE_INDEX_TTL = float(os.environ.get('PLATE_INDEX_TTL', 5))  # seconds, reload interval while change notifications are down
+
+db_pool = None
+
+# Cached lot state is tagged with cache_generation, bumped whenever a parking space changes.
+# Everything runs on the event loop, so no locks are needed around these.
+cache_generation = 0
+change_listener_ready = False
+broadcaster = ChangeBroadcaster()
+stream_wakeup = None  # asyncio.Event set on every published change, replaced after each use
+
+status_cache = None  # (cache generation, JSON body, ETag)
+status_lock = None  # one snapshot rebuild at a time, concurrent pollers wait for it
+listener_task = None
+
+plate_index = {}  # license plate -> slot ID of occupied parking spaces
+plate_index_loaded = 0
+plate_index_generation = -1
+
+def invalidate_caches():
+    """Mark the cached lot state of this process as stale"""
+    global cache_generation
+    cache_generation += 1
+
+def cache_is_fresh(generation):
+    """Cached lot state tagged with generation can be served without a database query"""
+    return generation == cache_generation and change_listener_ready
+
+def publish_changes(events):
+    """Fan change events out to the streaming clients of this process"""
+    global stream_wakeup
+    broadcaster.publish(events)
+    stream_wakeup.set()
+    stream_wakeup = asyncio.Event()
+
+def on_change(conn, pid, channel, payload):
+    """LISTEN callback, a worker committed parking space changes"""
+    invalidate_caches()
+    if payload:
+        publish_changes(json.loads(payload))
+
+async def listen_for_changes():
+    """Background task, keeps a LISTEN connection open and reconnects when it breaks"""
+    global change_listener_ready
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(os.environ['DATABASE_URL'])
+            await conn.add_listener(CHANGE_CHANNEL, on_change)
+            # Changes may have been missed while not listening
+            broadcaster.reset(await conn.fetchval(
+                "SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM parking_event_seq;"))
+            publish_changes([])
+            invalidate_caches()
+            change_listener_ready = True
+            while True:
+                await asyncio.sleep(DB_PING_INTERVAL)
+                await conn.fetchval("SELECT 1;")  # make sure the connection is still alive
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            change_listener_ready = False
+            print(f"✗ Change listener failed: {e}, retrying")
+            await asyncio.sleep(5)
+        finally:
+            if conn:
+                conn.terminate()
+
+async def migrate_database(conn):
+    """Apply pending schema migrations, returns the current schema version"""
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1);", SCHEMA_LOCK_ID)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        version = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+        for migration_version, sql in SCHEMA_MIGRATIONS:
+            if migration_version > version:
+                print(f"Applying schema migration {migration_version}")
+                await conn.execute(sql)
+                await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1);", migration_version)
+                version = migration_version
+    return version
+
+@app.before_serving
+async def init_database():
+    """Create the connection pool, migrate and seed the lot, start the change listener"""
+    global db_pool, status_lock, stream_wakeup, listener_task
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit("✗ DATABASE_URL is required, use parking_api.py for memory mode")
+
+    print(f"Creating connection pool to cloud database: {database_url[:20]}...") # Only show part of the connection string for security
+    db_pool = await asyncpg.create_pool(database_url, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX)
+    DB_POOL_SIZE.set(DB_POOL_MAX)
+    status_lock = asyncio.Lock()
+    stream_wakeup = asyncio.Event()
+
+    async with db_pool.acquire() as conn:
+        version = await migrate_database(conn)
+        # Create one row per parking space of the lot layout
+        await conn.execute("""
+            INSERT INTO parking_spaces (id, is_occupied)
+            SELECT unnest($1::int[]), FALSE
+            ON CONFLICT (id) DO NOTHING;
+        """, LOT.slot_ids)
+    print(f"✓ Database initialization complete (schema version {version})")
+
+    listener_task = asyncio.get_running_loop().create_task(listen_for_changes())
+
+@app.after_serving
+async def close_database():
+    listener_task.cancel()
+    await db_pool.close()
+
+def index_plates(spaces):
+    """Apply changed parking spaces, (id, is_occupied, plate_number) tuples, to the plate index"""
+    for space_id, is_occupied, plate_number in spaces:
+        for plate in [plate for plate, i in plate_index.items() if i == space_id]:
+            del plate_index[plate]
+        if is_occupied and plate_number:
+            plate_index[plate_number] = space_id
+
+async def lookup_plate(conn, plate):
+    """Slot ID of the parking space occupied by a license plate, None if not parked"""
+    global plate_index, plate_index_loaded, plate_index_generation
+    if not cache_is_fresh(plate_index_generation) and \
+            (change_listener_ready or time.time() - plate_index_loaded > PLATE_INDEX_TTL):
+        # Reload from the database, the other workers update it too
+        CACHE_REQUESTS.labels('plate_index', 'miss').inc()
+        generation = cache_generation
+        with DB_QUERY_SECONDS.labels('plate_index').time():
+            spaces = await conn.fetch(
+                "SELECT id, license_plate_number FROM parking_spaces WHERE is_occupied AND license_plate_number IS NOT NULL;")
+        plate_index = {space['license_plate_number']: space['id'] for space in spaces}
+        plate_index_loaded = time.time()
+        plate_index_generation = generation
+    else:
+        CACHE_REQUESTS.labels('plate_index', 'hit').inc()
+    return plate_index.get(plate)
+
+async def status_snapshot():
+    """JSON body and ETag of all parking spaces, rebuilt only after a parking space changes"""
+    global status_cache
+    async with status_lock:
+        cached = status_cache
+        if cached and cache_is_fresh(cached[0]):
+            CACHE_REQUESTS.labels('status', 'hit').inc()
+            return cached[1:]
+
+        CACHE_REQUESTS.labels('status', 'miss').inc()
+        generation = cache_generation
+        async with db_pool.acquire() as conn:
+            with DB_QUERY_SECONDS.labels('status').time():
+                spaces = await conn.fetch("SELECT * FROM parking_spaces ORDER BY id;")
+        result = [{
+            'id': space['id'],
+            'is_occupied': space['is_occupied'],
+            'plate_number': space['license_plate_number'],
+            'plate_color': space['license_plate_color']
+        } for space in spaces]
+
+        body = await jsonify(result).get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        status_cache = (generation, body, etag)
+        return body, etag
+
+@app.route('/', methods=['GET'])
+async def home():
+    """Home endpoint"""
+    return jsonify({
+        'message': 'Parking Management API Service',
+        'version': '1.0.0',
+        'endpoints': [
+            'POST /api/parking/update - Update parking space status',
+            'GET /api/parking/status - Query all parking spaces',
+            'GET /api/parking/my_status?plate=LICENSE - Query individual parking status',
+            'GET /api/parking/stream - Server-Sent Events of parking space changes',
+            'GET /api/parking/analytics?from=&to=&bucket=hour|day - Occupancy, turnover and dwell per slot'
+        ],
+        'status': 'running',
+        'current_time': (datetime.now() - timedelta(hours=4)).isoformat(),
+        'active_parkings': len(LOT)
+    })
+
+# One round of update events, parameters are parallel arrays, see event_rounds()
+UPDATE_SQL = """
+    WITH v AS (
+        SELECT * FROM unnest($1::int[], $2::bool[], $3::varchar[], $4::varchar[], $5::timestamp[], $6::timestamp[])
+            AS u (id, is_occupied, license_plate_number, license_plate_color, parking_time, updated_at)
+    ),
+    prev AS (
+        SELECT s.* FROM parking_spaces s JOIN v ON s.id = v.id
+    ),
+    changed AS (
+        INSERT INTO parking_spaces AS p (id, is_occupied, license_plate_number, license_plate_color, parking_time, updated_at)
+        SELECT * FROM v
+        ON CONFLICT (id) DO UPDATE SET
+            is_occupied = EXCLUDED.is_occupied,
+            license_plate_number = EXCLUDED.license_plate_number,
+            license_plate_color = EXCLUDED.license_plate_color,
+            parking_time = EXCLUDED.parking_time,
+            updated_at = EXCLUDED.updated_at
+        WHERE (p.is_occupied, p.license_plate_number) IS DISTINCT FROM (EXCLUDED.is_occupied, EXCLUDED.license_plate_number)
+        RETURNING p.id, p.is_occupied, p.license_plate_number, p.license_plate_color, p.updated_at,
+                  nextval('parking_event_seq') AS event_id
+    ),
+    -- 離開或換車時，將上一段停車紀錄寫入 parking_sessions
+    closed AS (
+        INSERT INTO parking_sessions (slot_id, license_plate_number, license_plate_color, entered_at, exited_at, fee)
+        SELECT prev.id, prev.license_plate_number, prev.license_plate_color, prev.parking_time,
+               GREATEST(changed.updated_at, prev.parking_time) AS exited_at,
+               parking_fee(prev.parking_time, GREATEST(changed.updated_at, prev.parking_time), prev.license_plate_color)
+        FROM prev JOIN changed ON prev.id = changed.id
+        WHERE prev.is_occupied AND prev.parking_time IS NOT NULL
+    )
+    SELECT id, is_occupied, license_plate_number, license_plate_color, event_id FROM changed ORDER BY event_id;
+"""
+
+@app.route('/api/parking/update', methods=['POST'])
+async def update_parking_status():
+    """Receive parking space status from Raspberry Pi, update DB only on change, see parking_api.py"""
+    try:
+        data = await request.get_json(silent=True)
+
+        if not is_valid_update(data, LOT.index):
+            return jsonify({
+                'success': False,
+                'error': f'Invalid data format, must be a list of parking spaces with IDs in {LOT.slot_ids}'
+            }), 400
+
+        current_time = datetime.now() - timedelta(hours=4)
+        # The payload may replay several outbox events of one space, applied in order
+        rounds = event_rounds(data)
+        spaces = {space.get('ID') for space in data}
+
+        # UPSERT，WHERE 條件跳過無變動的車位，RETURNING 回傳真正變動的車位，每輪事件一個語句
+        async with db_pool.acquire() as conn:
+            query_start = time.perf_counter()
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1);", EVENT_LOCK_ID)
+                changed = []
+                for events in rounds:
+                    # 以邊緣端事件時間為準，計算進入時間（僅在進入時紀錄）與離開時間
+                    updated_at = [event_time(space, current_time) for space in events]
+                    changed += await conn.fetch(UPDATE_SQL,
+                        [space.get('ID') for space in events],
+                        [space.get('IsOccupied', False) for space in events],
+                        [space.get('LicensePlateNumber') or None for space in events],
+                        [space.get('LicensePlateColor') or None for space in events],
+                        [t if space.get('IsOccupied', False) else None for t, space in zip(updated_at, events)],
+                        updated_at)
+                for payload in change_payloads(changed):
+                    await conn.execute("SELECT pg_notify($1, $2);", CHANGE_CHANNEL, payload)
+            DB_QUERY_SECONDS.labels('update').observe(time.perf_counter() - query_start)
+
+        index_plates((row['id'], row['is_occupied'], row['license_plate_number']) for row in changed)
+        changed = {row['id'] for row in changed}
+        if changed:
+            invalidate_caches()
+        UPDATE_SLOTS.labels('changed').inc(len(changed))
+        UPDATE_SLOTS.labels('unchanged').inc(len(spaces) - len(changed))
+
+        return jsonify({
+            'success': True,
+            'message': 'DB updated only on status change',
+            'changed': sorted(changed),
+            'timestamp': current_time.isoformat()
+        })
+
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/parking/status', methods=['GET'])
+async def get_parking_status():
+    """Query all parking spaces, served from the in-memory snapshot with a strong ETag"""
+    try:
+        body, etag = await status_snapshot()
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}  # clients revalidate with If-None-Match
+        if request.if_none_match.contains(etag):
+            return Response(b'', status=304, headers=headers)
+        return Response(body, mimetype='application/json', headers=headers)
+
+    except Exception as e:
+        print(f"✗ Error processing query request: {e}")
+        print(f"Error details: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'error': f'Query failed: {str(e)}'
+        }), 500
+
+@app.route('/api/parking/my_status', methods=['GET'])
+async def get_my_parking_status():
+    """Query individual parking status"""
+    try:
+        plate = request.args.get('plate')
+
+        if not plate:
+            return jsonify({
+                'success': False,
+                'error': 'License plate number is required'
+            }), 400
+
+        async with db_pool.acquire() as conn:
+            space = None
+            if await lookup_plate(conn, plate) is not None:
+                # Uses the partial plate index, the slot may have changed since the plate index was loaded
+                with DB_QUERY_SECONDS.labels('my_status').time():
+                    space = await conn.fetchrow(
+                        "SELECT * FROM parking_spaces WHERE license_plate_number = $1 AND is_occupied;", plate)
+
+        if space and space['parking_time']:
+            start_time = space['parking_time']
+            current_time = datetime.now() - timedelta(hours=4)
+
+            # Calculate parking duration
+            duration = current_time - start_time
+            duration_minutes = int(duration.total_seconds() / 60)
+
+            # Calculate parking fee
+            fee = calculate_fee(start_time, space['license_plate_color'])
+            return jsonify({
+                'is_parked': True,
+                'parking_slot': space['id'],
+                'license_plate_number': space['license_plate_number'],
+                'license_plate_color': space['license_plate_color'],
+                'started_at': start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'duration_minutes': duration_minutes,
+                'fee': fee
+            })
+
+        # Parking space not occupied
+        return jsonify({
+            'is_parked': False,
+            'message': 'No parking space occupied by this license plate'
+        })
+
+    except Exception as e:
+        print(f"✗ Error processing query request: {e}")
+        print(f"Error details: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'error': f'Query failed: {str(e)}'
+        }), 500
+
+@app.route('/api/parking/stream', methods=['GET'])
+async def stream_parking_status():
+    """Server-Sent Events stream of parking space changes, see parking_api.py"""
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+
+    async def generate():
+        nonlocal last_id
+        yield b"retry: 3000\n\n"
+        deadline = time.time() + STREAM_TIMEOUT
+        while time.time() < deadline:
+            wakeup = stream_wakeup
+            events = broadcaster.since(last_id)
+            if events is None:
+                # New client or too far behind, send the whole lot
+                last_id = broadcaster.last_id
+                body, _ = await status_snapshot()
+                yield f"id: {last_id}\nevent: snapshot\ndata: {body.decode()}\n\n".encode()
+                continue
+            for event_id, frame in events:
+                yield frame.encode()
+                last_id = event_id
+            if not events:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), max(min(STREAM_KEEPALIVE, deadline - time.time()), 0))
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None  # streams outlive the default response timeout
+    return response
+
+@app.route('/api/parking/analytics', methods=['GET'])
+async def get_parking_analytics():
+    """Occupancy rate, turnover and average dwell per slot per hour or day, see parking_api.py"""
+    try:
+        current_time = datetime.now() - timedelta(hours=4)
+        try:
+            start, end, bucket = analytics_range(request.args, current_time)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        async with db_pool.acquire() as conn:
+            with DB_QUERY_SECONDS.labels('analytics').time():
+                rows = await conn.fetch("SELECT * FROM parking_occupancy($1, $2, $3, $4);", start, end, bucket, current_time)
+
+        return jsonify({
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'bucket': bucket,
+            'data': format_analytics(rows, bucket)
+        })
+
+    except Exception as e:
+        print(f"✗ Error processing analytics request: {e}")
+        print(f"Error details: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'error': f'Query failed: {str(e)}'
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """Prometheus metrics of this process"""
+    DB_POOL_IN_USE.set(db_pool.get_size() - db_pool.get_idle_size())
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
+
+# Health check endpoint
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Health check endpoint, for Render platform to check database connection"""
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.fetchval("SELECT 1;")
+        db_status = "connected"
+    except Exception:
+        db_status = "disconnected"
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': (datetime.now() - timedelta(hours=4)).isoformat(),
+        'uptime': 'running',
+        'database': db_status
+    })
+
+@app.route('/api/reset', methods=['POST'])
+async def reset_parking_data():
+    """Reset parking_spaces table: truncate + insert the lot layout spaces"""
+    try:
+        # 安全驗證（避免被公開觸發）
+        secret = (await request.get_json()).get('secret_key')
+        if secret != os.environ.get("RESET_SECRET", "my_dev_key"):
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                # 清空資料表
+                await conn.execute("TRUNCATE TABLE parking_spaces RESTART IDENTITY;")
+
+                # 依車位配置初始化資料
+                await conn.execute("SELECT pg_advisory_xact_lock($1);", EVENT_LOCK_ID)
+                spaces = await conn.fetch("""
+                    INSERT INTO parking_spaces (id, is_occupied)
+                    SELECT unnest($1::int[]), FALSE
+                    RETURNING id, is_occupied, license_plate_number, license_plate_color,
+                              nextval('parking_event_seq') AS event_id;
+                """, LOT.slot_ids)
+                for payload in change_payloads(spaces):
+                    await conn.execute("SELECT pg_notify($1, $2);", CHANGE_CHANNEL, payload)
+
+        index_plates((i, False, None) for i in LOT.slot_ids)
+        invalidate_caches()
+
+        return jsonify({
+            'success': True,
+            'message': 'Database has been reset.',
+            'reset_at': (datetime.now() - timedelta(hours=4)).isoformat()
+        })
+
+    except Exception as e:
+        print(f"✗ Reset error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.errorhandler(404)
+async def not_found(error):
+    return jsonify({
+        'success': False,
+        'error': 'API endpoint not found'
+    }), 404
+
+@app.errorhandler(500)
+async def internal_error(error):
+    return jsonify({
+        'success': False,
+        'error': 'Internal server error'
+    }), 500
+
+if __name__ == '__main__':
+    # For local development
+    port = int(os.environ.get('PORT', 5000))
+    app.run(host='0.0.0.0', port=port)
@@ -10,7 +10,7 @@ import time
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Event, Thread
 
 import cv2
 import numpy as np
@@ -147,6 +147,8 @@ class LoadImages:  # for inference
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
+        self.timer = None  # optional StageTimer, times frame reading and letterboxing
+        self.letterbox_frames = True  # False if the consumer crops and letterboxes img0 itself
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -186,6 +188,10 @@ class LoadImages:  # for inference
             img0 = cv2.imread(path)  # BGR
             assert img0 is not None, 'Image Not Found ' + path
             #print(f'image {self.count}/{self.nf} {path}: ', end='')
+        if self.timer:
+            self.timer.lap('capture')
+        if not self.letterbox_frames:
+            return path, None, img0, self.cap
 
         # Padded resize
         img = letterbox(img0, self.img_size, stride=self.stride)[0]
@@ -193,6 +199,8 @@ class LoadImages:  # for inference
         # Convert
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         img = np.ascontiguousarray(img)
+        if self.timer:
+            self.timer.lap('letterbox')
 
         return path, img, img0, self.cap
 
@@ -268,6 +276,8 @@ class LoadStreams:  # multiple IP or RTSP cameras
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.timer = None  # optional StageTimer, times frame waiting and letterboxing
+        self.letterbox_frames = True  # False if the consumer crops and letterboxes img0 itself
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -276,7 +286,11 @@ class LoadStreams:  # multiple IP or RTSP cameras
             sources = [sources]
 
         n = len(sources)
-        self.imgs = [None] * n
+        self.latest = [None] * n  # (sequence number, frame) of the newest frame per stream
+        self.last_seqs = [-1] * n  # sequence numbers of the frames last returned
+        self.letterboxed = [None] * n  # letterboxed frames last returned
+        self.new_frame = Event()  # set by the update threads for every new frame
+        self.threads = [None] * n  # update thread per stream
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         for i, s in enumerate(sources):
             # Start the thread to read frames from the video stream
@@ -290,53 +304,79 @@ class LoadStreams:  # multiple IP or RTSP cameras
             assert cap.isOpened(), f'Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
+            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100 or 30  # 30 FPS if unknown
 
-            _, self.imgs[i] = cap.read()  # guarantee first frame
-            thread = Thread(target=self.update, args=([i, cap]), daemon=True)
+            _, im = cap.read()  # guarantee first frame
+            self.latest[i] = (0, im)
+            self.threads[i] = Thread(target=self.update, args=([i, cap]), daemon=True)
             print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
-            thread.start()
+            self.threads[i].start()
         print('')  # newline
 
         # check for common shapes
-        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for x in self.imgs], 0)  # shapes
+        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for _, x in self.latest], 0)  # shapes
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
     def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
+        # Read next stream frame in a daemon thread, every frame is a new array that is never written again
+        n, t = 0, 0
         while cap.isOpened():
+            time.sleep(max(0, 1 / self.fps - (time.time() - t)))  # rest of the frame period, if grab() did not block
+            t = time.time()
             n += 1
-            # _, self.imgs[index] = cap.read()
             cap.grab()
-            if n == 4:  # read every 4th frame
-                success, im = cap.retrieve()
-                self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+            if n < 4:  # read every 4th frame
+                continue
+            n = 0
+            seq, previous = self.latest[index]
+            success, im = cap.retrieve()
+            if not success:
+                im = np.zeros_like(previous)
+            self.latest[index] = (seq + 1, im)  # publish the complete frame, no lock or copy needed
+            self.new_frame.set()
 
     def __iter__(self):
         self.count = -1
         return self
 
     def __next__(self):
+        # Take the latest frame of every stream, waiting until at least one of them is new
+        while True:
+            self.new_frame.clear()
+            latest = self.latest.copy()
+            if any(seq != last for (seq, _), last in zip(latest, self.last_seqs)):
+                break
+            if not any(thread.is_alive() for thread in self.threads):
+                print('All streams closed')
+                raise StopIteration
+            self.new_frame.wait(1)
         self.count += 1
-        img0 = self.imgs.copy()
+        img0 = [x for _, x in latest]  # the published frames themselves, no copy
         if cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
+        if self.timer:
+            self.timer.lap('capture')
+
+        last_seqs, self.last_seqs = self.last_seqs, [seq for seq, _ in latest]
+        if not self.letterbox_frames:
+            return self.sources, None, img0, None
 
-        # Letterbox
-        img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
+        # Letterbox, streams without a new frame keep their letterboxed frame
+        for i, (seq, x) in enumerate(latest):
+            if seq != last_seqs[i] or self.letterboxed[i] is None:
+                self.letterboxed[i] = letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0]
 
         # Stack
-        img = np.stack(img, 0)
+        img = np.stack(self.letterboxed, 0)
 
         # Convert
         img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x416x416
         img = np.ascontiguousarray(img)
+        if self.timer:
+            self.timer.lap('letterbox')
 
         return self.sources, img, img0, None
 
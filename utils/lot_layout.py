@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Parking lot layout, shared by the edge detector and the API service
+import os
+import pickle
+
+import yaml
+
+LOT_CONFIG = os.environ.get('LOT_CONFIG', 'lot.yaml')
+
+
+class LotLayout:
+    """Parking lot layout: slot IDs, camera source and slot region polygons"""
+    def __init__(self, slot_ids, source='0', regions=None, polygons=None):
+        self.slot_ids = [int(x) for x in slot_ids]
+        self.source = str(source)
+        self.regions = regions  # matplo_place.py pickle of slot polygons, in slot order
+        self._polygons = polygons
+        assert len(set(self.slot_ids)) == len(self.slot_ids), f'Duplicate slot IDs in lot layout: {self.slot_ids}'
+        self.index = {slot_id: i for i, slot_id in enumerate(self.slot_ids)}  # slot ID -> slot index
+
+    def __len__(self):
+        return len(self.slot_ids)
+
+    @property
+    def polygons(self):
+        """Slot region polygons, loaded from the regions pickle on first use"""
+        if self._polygons is None:
+            with open(self.regions, 'rb') as f:
+                self._polygons = pickle.load(f)
+            assert len(self._polygons) == len(self.slot_ids), \
+                f'{self.regions} has {len(self._polygons)} regions for {len(self.slot_ids)} slots'
+        return self._polygons
+
+
+def load_lot_layout(path=LOT_CONFIG):
+    """Load the lot layout yaml, falls back to the default 4 slot lot if the file does not exist"""
+    cfg = {}
+    if path and os.path.isfile(path):
+        with open(path) as f:
+            cfg = yaml.load(f, Loader=yaml.SafeLoader) or {}
+
+    slots = cfg.get('slots', 4)
+    slot_ids = range(1, slots + 1) if isinstance(slots, int) else slots  # slot count or list of slot IDs
+    return LotLayout(slot_ids, source=cfg.get('source', '0'), regions=cfg.get('regions', 'weights/new_pkg.p'),
+                     polygons=cfg.get('polygons'))
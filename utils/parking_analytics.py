@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Occupancy analytics: hourly rollups of finished parking sessions, kept up to date by a trigger
+# on parking_sessions, and the queries behind /api/parking/analytics
+from datetime import datetime, timedelta, timezone
+
+ANALYTICS_BUCKETS = {'hour': 3600, 'day': 86400}  # bucket -> seconds
+ANALYTICS_MAX_BUCKETS = 24 * 31  # buckets per slot in one request
+
+# Schema migration 5, applied by SCHEMA_MIGRATIONS in utils/parking_common.py
+ROLLUP_MIGRATION = """
+    -- One row per slot per hour, only finished sessions are rolled up
+    CREATE TABLE IF NOT EXISTS parking_occupancy_hourly (
+        hour TIMESTAMP NOT NULL,
+        slot_id INTEGER NOT NULL,
+        occupied_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+        arrivals INTEGER NOT NULL DEFAULT 0,  -- sessions that started in this hour
+        departures INTEGER NOT NULL DEFAULT 0,  -- sessions that ended in this hour
+        dwell_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,  -- total length of the sessions that ended in this hour
+        PRIMARY KEY (hour, slot_id)
+    );
+
+    -- Add one finished session to every hour it spans
+    CREATE OR REPLACE FUNCTION rollup_parking_session(slot INTEGER, entered TIMESTAMP, exited TIMESTAMP)
+    RETURNS VOID AS $$
+        INSERT INTO parking_occupancy_hourly AS h (hour, slot_id, occupied_seconds, arrivals, departures, dwell_seconds)
+        SELECT hour, slot,
+               EXTRACT(EPOCH FROM LEAST(hour + interval '1 hour', exited) - GREATEST(hour, entered)),
+               (hour = date_trunc('hour', entered))::INTEGER,
+               (hour = date_trunc('hour', exited))::INTEGER,
+               CASE WHEN hour = date_trunc('hour', exited) THEN EXTRACT(EPOCH FROM exited - entered) ELSE 0 END
+        FROM generate_series(date_trunc('hour', entered), exited, interval '1 hour') AS hour
+        ON CONFLICT (hour, slot_id) DO UPDATE SET
+            occupied_seconds = h.occupied_seconds + EXCLUDED.occupied_seconds,
+            arrivals = h.arrivals + EXCLUDED.arrivals,
+            departures = h.departures + EXCLUDED.departures,
+            dwell_seconds = h.dwell_seconds + EXCLUDED.dwell_seconds;
+    $$ LANGUAGE SQL;
+
+    CREATE OR REPLACE FUNCTION parking_sessions_rollup() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM rollup_parking_session(NEW.slot_id, NEW.entered_at, NEW.exited_at);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS parking_sessions_rollup ON parking_sessions;
+    CREATE TRIGGER parking_sessions_rollup AFTER INSERT ON parking_sessions
+        FOR EACH ROW EXECUTE FUNCTION parking_sessions_rollup();
+
+    -- Sessions recorded before this migration
+    SELECT rollup_parking_session(slot_id, entered_at, exited_at) FROM parking_sessions;
+
+    -- Rollups per hour or day bucket, ongoing sessions are added on the fly from parking_spaces
+    CREATE OR REPLACE FUNCTION parking_occupancy(start_at TIMESTAMP, end_at TIMESTAMP, bucket TEXT, now_at TIMESTAMP)
+    RETURNS TABLE (bucket_start TIMESTAMP, slot_id INTEGER, occupied_seconds DOUBLE PRECISION,
+                   arrivals BIGINT, departures BIGINT, dwell_seconds DOUBLE PRECISION) AS $$
+        WITH hours AS (
+            SELECT h.hour, h.slot_id, h.occupied_seconds, h.arrivals, h.departures, h.dwell_seconds
+            FROM parking_occupancy_hourly h
+            WHERE h.hour >= start_at AND h.hour < end_at
+            UNION ALL
+            SELECT hour, s.id,
+                   EXTRACT(EPOCH FROM LEAST(hour + interval '1 hour', now_at) - GREATEST(hour, s.parking_time)),
+                   (hour = date_trunc('hour', s.parking_time))::INTEGER, 0, 0
+            FROM parking_spaces s,
+                 generate_series(date_trunc('hour', GREATEST(s.parking_time, start_at)),
+                                 LEAST(now_at, end_at) - interval '1 microsecond', interval '1 hour') AS hour
+            WHERE s.is_occupied AND s.parking_time IS NOT NULL
+        )
+        SELECT date_trunc(bucket, hour), slot_id, SUM(occupied_seconds)::DOUBLE PRECISION,
+               SUM(arrivals), SUM(departures), SUM(dwell_seconds)::DOUBLE PRECISION
+        FROM hours
+        GROUP BY 1, 2
+        ORDER BY 1, 2;
+    $$ LANGUAGE SQL STABLE;
+"""
+
+
+def bucket_floor(t, bucket):
+    """Start of the hour or day bucket holding t"""
+    t = t.replace(minute=0, second=0, microsecond=0)
+    return t.replace(hour=0) if bucket == 'day' else t
+
+
+def analytics_range(args, current_time):
+    """Parse the from, to and bucket query arguments into bucket aligned (start, end, bucket)
+
+    Raises ValueError with a message for the client if the arguments are invalid.
+    """
+    bucket = args.get('bucket', 'hour')
+    if bucket not in ANALYTICS_BUCKETS:
+        raise ValueError(f"bucket must be one of {list(ANALYTICS_BUCKETS)}")
+    try:
+        end = datetime.fromisoformat(args['to']) if args.get('to') else current_time
+        start = datetime.fromisoformat(args['from']) if args.get('from') else \
+            end - timedelta(days=1 if bucket == 'hour' else 30)
+    except ValueError:
+        raise ValueError('from and to must be ISO 8601 dates or times')
+    # Same clock as current_time: UTC shifted by 4 hours
+    start, end = [t.astimezone(timezone.utc).replace(tzinfo=None) - timedelta(hours=4) if t.tzinfo else t
+                  for t in (start, end)]
+
+    size = timedelta(seconds=ANALYTICS_BUCKETS[bucket])
+    start = bucket_floor(start, bucket)
+    end = bucket_floor(end, bucket) + (size if end != bucket_floor(end, bucket) else timedelta(0))
+    if start >= end:
+        raise ValueError('from must be before to')
+    if (end - start) / size > ANALYTICS_MAX_BUCKETS:
+        raise ValueError(f'At most {ANALYTICS_MAX_BUCKETS} {bucket} buckets per request')
+    return start, end, bucket
+
+
+def rollup_sessions(sessions, start, end, bucket, current_time):
+    """Python twin of the parking_occupancy() SQL function, for memory mode
+
+    sessions are dicts with slot_id, entered_at and exited_at (None while still parked)
+    """
+    size = timedelta(seconds=ANALYTICS_BUCKETS[bucket])
+    totals = {}
+    for session in sessions:
+        entered = session['entered_at']
+        exited = session['exited_at'] or current_time
+        t = max(bucket_floor(entered, bucket), start)
+        while t < min(exited, end):
+            row = totals.setdefault((t, session['slot_id']), {
+                'occupied_seconds': 0.0, 'arrivals': 0, 'departures': 0, 'dwell_seconds': 0.0})
+            row['occupied_seconds'] += (min(t + size, exited) - max(t, entered)).total_seconds()
+            row['arrivals'] += t <= entered < t + size
+            if session['exited_at'] and t <= exited < t + size:
+                row['departures'] += 1
+                row['dwell_seconds'] += (exited - entered).total_seconds()
+            t += size
+    return [dict(bucket_start=t, slot_id=slot_id, **row) for (t, slot_id), row in sorted(totals.items())]
+
+
+def format_analytics(rows, bucket):
+    """Occupancy rate, turnover and average dwell of parking_occupancy() rows"""
+    return [{
+        'bucket': row['bucket_start'].isoformat(),
+        'slot_id': row['slot_id'],
+        'occupancy_rate': round(row['occupied_seconds'] / ANALYTICS_BUCKETS[bucket], 4),
+        'turnover': row['arrivals'],  # sessions started in the bucket
+        'departures': row['departures'],
+        'avg_dwell_minutes': round(row['dwell_seconds'] / row['departures'] / 60, 1) if row['departures'] else None
+    } for row in rows]
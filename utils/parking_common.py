@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Parking API pieces shared by parking_api.py (Flask) and parking_api_async.py (ASGI)
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from utils.parking_analytics import ROLLUP_MIGRATION
+
+# Versioned schema migrations, applied in order and recorded in schema_migrations
+SCHEMA_MIGRATIONS = [
+    (1, """
+        CREATE TABLE IF NOT EXISTS parking_spaces (
+            id INTEGER PRIMARY KEY,
+            is_occupied BOOLEAN DEFAULT FALSE,
+            license_plate_number VARCHAR(20),
+            license_plate_color VARCHAR(20),
+            parking_time TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+    (2, """
+        CREATE INDEX IF NOT EXISTS idx_parking_spaces_occupied_plate
+            ON parking_spaces (license_plate_number) WHERE is_occupied;
+    """),
+    (3, """
+        CREATE SEQUENCE IF NOT EXISTS parking_event_seq;
+    """),
+    (4, """
+        -- Append-only history, one row per finished parking session
+        CREATE TABLE IF NOT EXISTS parking_sessions (
+            id BIGSERIAL PRIMARY KEY,
+            slot_id INTEGER NOT NULL,
+            license_plate_number VARCHAR(20),
+            license_plate_color VARCHAR(20),
+            entered_at TIMESTAMP NOT NULL,
+            exited_at TIMESTAMP NOT NULL,
+            fee INTEGER NOT NULL
+        );
+        -- Rows arrive in time order, a BRIN index keeps range scans over months of sessions cheap
+        CREATE INDEX IF NOT EXISTS idx_parking_sessions_entered_at ON parking_sessions USING BRIN (entered_at);
+        -- SQL twin of calculate_fee
+        CREATE OR REPLACE FUNCTION parking_fee(entered_at TIMESTAMP, exited_at TIMESTAMP, plate_color VARCHAR)
+        RETURNS INTEGER AS $$
+            SELECT (floor(EXTRACT(EPOCH FROM exited_at - entered_at))::INTEGER / 10)
+                   * CASE WHEN lower(plate_color) IN ('red', 'yellow') THEN 2 ELSE 1 END;
+        $$ LANGUAGE SQL IMMUTABLE;
+    """),
+    (5, ROLLUP_MIGRATION),
+]
+SCHEMA_LOCK_ID = 7262001  # advisory lock key, so concurrent workers migrate one at a time
+
+# Change notifications between API workers, payload is a JSON list of change events
+CHANGE_CHANNEL = 'parking_spaces_changed'
+EVENT_LOCK_ID = 7262002  # advisory lock key, so change event IDs are assigned in commit order
+
+# Server-Sent Events stream settings
+STREAM_BUFFER = int(os.environ.get('STREAM_BUFFER', 1000))  # change events kept for Last-Event-ID resume
+STREAM_KEEPALIVE = 15  # seconds between keep-alive comments
+STREAM_TIMEOUT = float(os.environ.get('STREAM_TIMEOUT', 300))  # seconds before a stream is closed, clients reconnect
+
+class ChangeBroadcaster:
+    """In-process fan-out of parking space change events to the streaming clients of this worker
+
+    The latest events stay in a ring buffer so reconnecting clients resume from their
+    Last-Event-ID, clients further behind get a new snapshot instead.
+    """
+    def __init__(self, maxlen=STREAM_BUFFER):
+        self.events = deque(maxlen=maxlen)  # (event ID, SSE frame), IDs ascending
+        self.base_id = 0  # events up to this ID are no longer buffered
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def reset(self, last_id):
+        """Drop the buffered events, clients resume with a snapshot"""
+        with self.condition:
+            self.events.clear()
+            self.base_id = self.last_id = last_id
+            self.condition.notify_all()
+
+    def publish(self, events):
+        """Publish change event dicts, events without an 'event_id' get the next local ID"""
+        with self.condition:
+            for event in events:
+                event = dict(event)
+                event_id = event.pop('event_id', None) or self.last_id + 1
+                if event_id <= self.last_id:
+                    continue  # already published
+                if len(self.events) == self.events.maxlen:
+                    self.base_id = self.events[0][0]
+                # Formatted once, shared by every client
+                self.events.append((event_id, f"id: {event_id}\nevent: slot\ndata: {json.dumps(event)}\n\n"))
+                self.last_id = event_id
+            self.condition.notify_all()
+
+    def since(self, last_id):
+        """Events after last_id, None if the client needs a new snapshot"""
+        with self.condition:
+            if last_id is None or not self.base_id <= last_id <= self.last_id:
+                return None
+            events = []
+            for event in reversed(self.events):
+                if event[0] <= last_id:
+                    break
+                events.append(event)
+            return events[::-1]
+
+    def wait(self, last_id, timeout):
+        """Wait until events after last_id are published, False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.last_id != last_id, timeout)
+
+
+def change_payloads(spaces, chunk=50):
+    """NOTIFY payloads for changed parking spaces
+
+    spaces are RETURNING rows with id, is_occupied, license_plate_number, license_plate_color, event_id
+    """
+    events = [{
+        'event_id': space['event_id'],
+        'id': space['id'],
+        'is_occupied': space['is_occupied'],
+        'plate_number': space['license_plate_number'],
+        'plate_color': space['license_plate_color']
+    } for space in spaces]
+    # NOTIFY payloads are limited to 8000 bytes
+    return [json.dumps(events[i:i + chunk]) for i in range(0, len(events), chunk)]
+
+
+def calculate_fee(start_time, plate_color=None, end_time=None):
+    """Calculate parking fee based on plate color, until now unless end_time is given
+    White plate: 1 per 10 seconds 
+    Red/Yellow plate: 2 per 10 seconds 
+    The parking_fee() SQL function of schema migration 4 must stay in sync.
+    """
+    if not start_time:
+        return 0
+    
+    current_time = end_time or datetime.now() - timedelta(hours=4)
+    if isinstance(start_time, str):
+        start_time = datetime.fromisoformat(start_time.replace('T', ' '))
+    
+    duration = current_time - start_time
+    duration_seconds = int(duration.total_seconds())
+    
+    # Calculate fee based on plate color
+    if plate_color and (plate_color.lower() == 'red' or plate_color.lower() == 'yellow'):
+        # Red/Yellow plate: 2 per 10 seconds
+        return (duration_seconds // 10) * 2
+    else:
+        # White plate (default): 1 per 10 seconds
+        return duration_seconds // 10
+
+
+def is_valid_update(data, slot_index):
+    """Whether an update payload is a non-empty list of parking space objects with known integer IDs"""
+    if not data or not isinstance(data, list):
+        return False
+    for space in data:
+        if not isinstance(space, dict):
+            return False
+        space_id = space.get('ID')
+        if not isinstance(space_id, int) or isinstance(space_id, bool) or space_id not in slot_index:
+            return False
+    return True
+
+
+def event_rounds(data):
+    """Split an update payload into rounds, round k holds the k-th event of every parking space
+
+    The payload may replay several outbox events of one space, oldest first. Applying the
+    rounds one after another keeps the sessions that started and ended while the edge was
+    offline. Repeated events with the same state of a space change nothing and are dropped.
+    """
+    events = {}
+    for space in data:
+        queue = events.setdefault(space.get('ID'), [])
+        state = (space.get('IsOccupied', False), space.get('LicensePlateNumber') or None)
+        if not queue or queue[-1][0] != state:
+            queue.append((state, space))
+    rounds = max(map(len, events.values()), default=0)
+    return [[queue[k][1] for queue in events.values() if k < len(queue)] for k in range(rounds)]
+
+
+def event_time(space, current_time):
+    """Edge-side event time of a parking space update, server time if missing or invalid"""
+    timestamp = space.get('Timestamp')
+    if not timestamp:
+        return current_time
+    try:
+        event_time = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return current_time
+    if event_time.tzinfo:
+        # Same clock as current_time: UTC shifted by 4 hours
+        event_time = event_time.astimezone(timezone.utc).replace(tzinfo=None) - timedelta(hours=4)
+    return min(event_time, current_time)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Prometheus metrics of the parking API, no-ops when prometheus_client is not installed.
+# With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR to a writable directory (see gunicorn.conf.py)
+import contextlib
+import os
+
+try:
+    import prometheus_client  # for /metrics
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+
+class NoMetric:
+    """Stand-in for every metric when prometheus_client is not installed"""
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return contextlib.nullcontext()
+
+
+def metric(kind, name, documentation, labelnames=(), **kwargs):
+    """Create a prometheus_client metric, e.g. metric('Counter', ...), NoMetric without prometheus_client"""
+    if prometheus_client is None:
+        return NoMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+REQUESTS = metric('Counter', 'parking_api_requests', 'HTTP requests', ('route', 'method', 'status'))
+REQUEST_SECONDS = metric('Histogram', 'parking_api_request_seconds', 'HTTP request latency until the response is ready',
+                         ('route',), buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = metric('Histogram', 'parking_api_db_query_seconds', 'Database query time', ('query',),
+                          buckets=LATENCY_BUCKETS)
+DB_ACQUIRE_SECONDS = metric('Histogram', 'parking_api_db_acquire_seconds', 'Time to get a pooled database connection',
+                            buckets=LATENCY_BUCKETS)
+DB_POOL_IN_USE = metric('Gauge', 'parking_api_db_pool_in_use', 'Database connections checked out',
+                        multiprocess_mode='livesum')
+DB_POOL_SIZE = metric('Gauge', 'parking_api_db_pool_size', 'Maximum database connections',
+                      multiprocess_mode='livesum')
+DB_POOL_EXHAUSTED = metric('Counter', 'parking_api_db_pool_exhausted', 'Requests that found every pooled connection in use')
+CACHE_REQUESTS = metric('Counter', 'parking_api_cache_requests', 'Lookups of the in-process caches, hit or miss',
+                        ('cache', 'result'))
+UPDATE_SLOTS = metric('Counter', 'parking_api_update_slots', 'Parking spaces received by /api/parking/update, '
+                      'changed or unchanged', ('result',))
+
+
+def metrics_response():
+    """(body, content type) of the current metrics, merged across worker processes in multiprocess mode"""
+    if prometheus_client is None:
+        return b'# prometheus_client is not installed\n', 'text/plain; charset=utf-8'
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
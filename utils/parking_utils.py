@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 import os
 import re
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import cv2
 import numpy as np
 import requests
+import torch
+import torchvision
+from scipy.optimize import linear_sum_assignment
 from shapely.geometry import Polygon as shapely_poly
 
+from utils.datasets import letterbox
+from utils.general import box_iou, scale_coords
+from utils.torch_utils import time_synchronized
+
 # API tm - iHqLܶq]mAPIa}
 API_URL = os.environ.get('API_URL', 'https://parking-management-api-lyvg.onrender.com/api/parking/update')
 
@@ -15,11 +30,12 @@ class Car:
         self.has_parking = False
         self.number_plate = "None"
         self.color = "None"
+        self.track = None  # Track of the parked vehicle
 
 def detect_color(p):
-    """Detect the color of a license plate"""
+    """Detect the color of a license plate, p is an image path or a BGR image"""
     try:
-        img = cv2.imread(str(p))
+        img = p if isinstance(p, np.ndarray) else cv2.imread(str(p))
         if img is None:
             return "Unknown"
         
@@ -97,6 +113,301 @@ def shape_poly(box):
         # If box is a list of points
         return shapely_poly([(point[0], point[1]) for point in box])
 
+class SlotMasks:
+    """Parking slot polygons rasterized once, with one integral image per slot
+
+    The polygon area covered by any box is then 4 lookups per slot/box pair,
+    so occupancy keeps the true slot shape without shapely in the hot path.
+    """
+    def __init__(self, polygons, shape, scale=0.25):
+        self.shape = tuple(shape[:2])  # frame (height, width)
+        self.scale = scale  # mask resolution relative to the frame
+        self.polygons = [np.asarray(p, dtype=np.float32) for p in polygons]
+        h, w = int(round(self.shape[0] * scale)), int(round(self.shape[1] * scale))
+
+        boxes, integrals = [], []
+        for poly in self.polygons:
+            pts = poly * scale
+            x0, y0 = np.clip(np.floor(pts.min(0)).astype(int), 0, [w, h])
+            x1, y1 = np.clip(np.ceil(pts.max(0)).astype(int), 0, [w, h])
+            mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.fillPoly(mask, [np.round(pts - [x0, y0]).astype(np.int32)], 1)
+            boxes.append([x0, y0, x1, y1])
+            integrals.append(cv2.integral(mask).astype(np.int64))  # (h+1)x(w+1)
+
+        # Pack all integral images into one flat array for vectorized lookups
+        self.boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)  # slot bounds in mask pixels
+        self.strides = np.array([x.shape[1] for x in integrals], dtype=np.int64)
+        self.offsets = np.cumsum([0] + [x.size for x in integrals[:-1]]).astype(np.int64)
+        self.integral = np.concatenate([x.ravel() for x in integrals]) if integrals else np.zeros(0, np.int64)
+        self.areas = np.array([x[-1, -1] for x in integrals], dtype=np.float32)  # slot areas in mask pixels
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def intersection(self, boxes):
+        """Area of each slot polygon covered by each xyxy box (ndarray[D, 4]), returns ndarray[S, D] in mask pixels"""
+        b = np.round(np.asarray(boxes, dtype=np.float32) * self.scale).astype(np.int64)
+        sx0, sy0, sx1, sy1 = (self.boxes[:, i, None] for i in range(4))
+        # Clip boxes to every slot's bounds, in local slot coordinates
+        x0 = np.clip(b[None, :, 0], sx0, sx1) - sx0
+        y0 = np.clip(b[None, :, 1], sy0, sy1) - sy0
+        x1 = np.clip(b[None, :, 2], sx0, sx1) - sx0
+        y1 = np.clip(b[None, :, 3], sy0, sy1) - sy0
+
+        offset, stride = self.offsets[:, None], self.strides[:, None]
+        lookup = lambda y, x: self.integral[offset + y * stride + x]
+        return lookup(y1, x1) - lookup(y0, x1) - lookup(y1, x0) + lookup(y0, x0)
+
+    def iou(self, boxes):
+        """IoU of every slot polygon with every xyxy box (Tensor[D, 4]), returns Tensor[S, D]"""
+        b = boxes.float().cpu().numpy()
+        inter = self.intersection(b).astype(np.float32)
+        b = np.round(b * self.scale)
+        area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        iou = inter / (self.areas[:, None] + area[None] - inter + 1e-16)
+        return torch.from_numpy(iou).to(boxes.device)
+
+class MotionGate:
+    """Skip the detector on static frames
+
+    Frames are downsampled to width pixels in grayscale and compared with the frames
+    the detector last ran on. A slot has changed when more than area of its bounding
+    box differs by more than thres gray levels. The detector runs when any slot of any
+    frame changed, and at least every keyframe_interval seconds to catch slow changes.
+    """
+    def __init__(self, slot_boxes, thres=25, area=0.05, keyframe_interval=30.0, width=160):
+        self.slot_boxes = np.asarray(slot_boxes, dtype=np.float32).reshape(-1, 4)  # xyxy in frame pixels
+        self.thres = thres
+        self.area = area
+        self.keyframe_interval = keyframe_interval
+        self.width = width
+        self.reference = None  # downsampled frames the detector last ran on
+        self.last_run = 0.0
+
+    def small(self, frame):
+        h = max(1, round(frame.shape[0] * self.width / frame.shape[1]))
+        small = cv2.resize(frame, (self.width, h), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+    def changed(self, frames, small):
+        """Whether any slot region differs from the reference frames"""
+        if self.reference is None or [x.shape for x in small] != [x.shape for x in self.reference]:
+            return True
+        for frame, s, r in zip(frames, small, self.reference):
+            diff = cv2.absdiff(s, r) > self.thres
+            boxes = np.round(self.slot_boxes * (self.width / frame.shape[1])).astype(int)
+            for x0, y0, x1, y1 in np.clip(boxes, 0, [s.shape[1], s.shape[0]] * 2):
+                if x1 > x0 and y1 > y0 and diff[y0:y1, x0:x1].mean() > self.area:
+                    return True
+        return False
+
+    def __call__(self, frames):
+        """True if the detector should run on frames, a list of BGR images"""
+        small = [self.small(x) for x in frames]
+        if not self.changed(frames, small) and time.time() - self.last_run < self.keyframe_interval:
+            return False
+        self.reference = small
+        self.last_run = time.time()
+        return True
+
+class RoiTiles:
+    """Crop frames to tiles over the parking slots, so distant slots keep more pixels at the same img_size
+
+    The union bounding box of the slots, padded by pad of the frame size, is split into n
+    tiles along its longer side, overlapping by 2 * pad so a vehicle on a tile border is
+    whole in at least one tile. Tiles are letterboxed to img_size squares and batched,
+    detections are mapped back to frame coordinates and merged across tiles with NMS.
+    """
+    def __init__(self, slot_boxes, n=1, img_size=320, pad=0.05):
+        self.slot_boxes = np.asarray(slot_boxes, dtype=np.float32).reshape(-1, 4)  # xyxy in frame pixels
+        self.n = n
+        self.img_size = img_size
+        self.pad = pad
+        self.shape = None  # frame (height, width) of the cached tiles
+        self.tiles = None  # n x 4 xyxy tiles in frame pixels
+
+    def layout(self, shape):
+        """Tiles for frames of shape, computed once per frame resolution"""
+        if tuple(shape[:2]) != self.shape:
+            h, w = shape[:2]
+            if not len(self.slot_boxes):
+                tiles = [[0, 0, w, h]]
+            else:
+                pad = self.pad * max(h, w)
+                x0, y0 = self.slot_boxes[:, :2].min(0) - pad
+                x1, y1 = self.slot_boxes[:, 2:].max(0) + pad
+                horizontal = x1 - x0 >= y1 - y0
+                lo, hi = (x0, x1) if horizontal else (y0, y1)
+                step = (hi - lo) / self.n
+                tiles = []
+                for k in range(self.n):
+                    a = lo + k * step - (pad if k > 0 else 0)
+                    b = lo + (k + 1) * step + (pad if k < self.n - 1 else 0)
+                    tiles.append([a, y0, b, y1] if horizontal else [x0, a, x1, b])
+            self.tiles = np.clip(np.round(tiles), 0, [w, h, w, h]).astype(int)
+            self.shape = tuple(shape[:2])
+        return self.tiles
+
+    def crop(self, frames):
+        """Letterboxed RGB tiles of every frame, ndarray[F * n, 3, img_size, img_size]"""
+        img = [letterbox(frame[y0:y1, x0:x1], self.img_size, auto=False)[0]
+               for frame in frames for x0, y0, x1, y1 in self.layout(frame.shape)]
+        img = np.stack(img, 0)[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3ximg_sizeximg_size
+        return np.ascontiguousarray(img)
+
+    def merge(self, pred, frames, iou_thres=0.45):
+        """Map the per-tile detections of non_max_suppression() to frame coordinates, one Tensor[D, 6] per frame"""
+        merged = []
+        for i, frame in enumerate(frames):
+            tiles = self.layout(frame.shape)
+            dets = []
+            for det, (x0, y0, x1, y1) in zip(pred[i * len(tiles):(i + 1) * len(tiles)], tiles):
+                det[:, :4] = scale_coords((self.img_size, self.img_size), det[:, :4], (y1 - y0, x1 - x0))
+                det[:, [0, 2]] += x0
+                det[:, [1, 3]] += y0
+                dets.append(det)
+            det = torch.cat(dets)
+            if len(tiles) > 1 and len(det):  # the same vehicle seen by overlapping tiles
+                det = det[torchvision.ops.batched_nms(det[:, :4], det[:, 4], det[:, 5].long(), iou_thres)]
+            merged.append(det)
+        return merged
+
+def assign_parking(slot_boxes, vehicle_boxes, plate_boxes, slot_iou_thres=0.2, plate_iou_thres=0.01):
+    """Assign vehicles to parking slots and plates to vehicles in one shot
+    All boxes are expected to be in (x1, y1, x2, y2) format.
+    Arguments:
+        slot_boxes (Tensor[S, 4] or SlotMasks)
+        vehicle_boxes (Tensor[M, 4])
+        plate_boxes (Tensor[P, 4])
+    Returns:
+        vehicle (Tensor[S]): index of the best overlapping vehicle per slot, -1 if the slot is free
+        plate (Tensor[S]): index of the best overlapping plate of that vehicle, -1 if none
+    """
+    vehicle = torch.full((len(slot_boxes),), -1, dtype=torch.long, device=vehicle_boxes.device)
+    plate = vehicle.clone()
+    if not len(vehicle_boxes):
+        return vehicle, plate
+
+    # slot x vehicle IoU matrix, best vehicle per slot
+    if isinstance(slot_boxes, SlotMasks):
+        iou, best = slot_boxes.iou(vehicle_boxes).max(1)
+    else:
+        iou, best = box_iou(slot_boxes.float(), vehicle_boxes.float()).max(1)
+    occupied = iou > slot_iou_thres
+    vehicle[occupied] = best[occupied]
+
+    if len(plate_boxes):
+        # vehicle x plate IoU matrix, best plate per vehicle
+        iou, best = box_iou(vehicle_boxes.float(), plate_boxes.float()).max(1)
+        vehicle_plate = torch.where(iou > plate_iou_thres, best, torch.full_like(best, -1))
+        plate[occupied] = vehicle_plate[vehicle[occupied]]
+    return vehicle, plate
+
+class Track:
+    """One tracked vehicle: a constant velocity Kalman filter over its box center and size, and its plate read"""
+    F = np.eye(8) + np.eye(8, k=4)  # state cx, cy, w, h, then their velocities per update
+    H = np.eye(4, 8)  # the box is measured, not its velocity
+    Q = np.diag([1., 1., 1., 1., .01, .01, .01, .01])  # process noise
+    R = np.diag([10., 10., 10., 10.])  # measurement noise, pixels^2
+    count = 0  # track IDs issued so far
+
+    def __init__(self, box):
+        Track.count += 1
+        self.id = Track.count
+        x1, y1, x2, y2 = box
+        self.x = np.array([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1, 0., 0., 0., 0.])
+        self.P = np.diag([10., 10., 10., 10., 1e4, 1e4, 1e4, 1e4])  # velocity unknown at first
+        self.misses = 0  # consecutive updates without a matching detection
+        self.created = time.time()
+        self.parked = None  # time the vehicle was first seen in a parking slot, the plate read starts then
+        self.number = "None"  # best valid plate read so far, normalized
+        self.color = "None"
+        self.reads = 0  # plate reads attempted
+        self.frozen = False  # the plate is final, it never changes during a stay
+
+    @property
+    def box(self):
+        cx, cy, w, h = self.x[:4]
+        return np.array([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2])
+
+    def predict(self):
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        return self.box
+
+    def correct(self, box):
+        x1, y1, x2, y2 = box
+        y = np.array([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1]) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ y
+        self.P = (np.eye(8) - K @ self.H) @ self.P
+        self.misses = 0
+
+    def add_read(self, number, color, min_chars=4):
+        """Keep the longest valid plate read, final once it has min_chars characters"""
+        self.reads += 1
+        number = normalize_license_plate(number)
+        if self.frozen or number == "None":
+            return
+        if len(number.replace("-", "")) > len(self.number.replace("-", "").replace("None", "")):
+            self.number, self.color = number, color
+        self.frozen = len(self.number.replace("-", "")) >= min_chars
+
+
+class VehicleTracker:
+    """IoU tracker with a Kalman filter per track, gives vehicles persistent IDs across frames
+
+    Detections are matched to the predicted track boxes by IoU with the Hungarian
+    algorithm. Tracks without a match for max_misses updates are dropped. Plates are
+    read once per track: needs_read() is True until a valid read has at least min_chars
+    characters, max_reads reads were attempted or read_timeout seconds passed since the
+    vehicle was first seen in a slot (park()). The plate cached on the track is final
+    from then on.
+    """
+    def __init__(self, iou_thres=0.3, max_misses=5, min_chars=4, max_reads=5, read_timeout=10.0):
+        self.iou_thres = iou_thres
+        self.max_misses = max_misses
+        self.min_chars = min_chars
+        self.max_reads = max_reads
+        self.read_timeout = read_timeout
+        self.tracks = []
+
+    def update(self, boxes):
+        """Match xyxy boxes (Tensor[M, 4]) to the tracks, returns the Track of every box"""
+        boxes = boxes.float().cpu().reshape(-1, 4)
+        predicted = torch.tensor(np.array([t.predict() for t in self.tracks]), dtype=torch.float32).reshape(-1, 4)
+        iou = box_iou(predicted, boxes).numpy()
+        matches = [None] * len(boxes)
+        for t, d in zip(*linear_sum_assignment(-iou)):
+            if iou[t, d] >= self.iou_thres:
+                self.tracks[t].correct(boxes[d].tolist())
+                matches[d] = self.tracks[t]
+        matched = {id(m) for m in matches if m is not None}
+        for track in self.tracks:
+            if id(track) not in matched:
+                track.misses += 1
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        for d, box in enumerate(boxes.tolist()):
+            if matches[d] is None:  # a new vehicle
+                matches[d] = Track(box)
+                self.tracks.append(matches[d])
+        return matches
+
+    def park(self, track):
+        """Mark track as seen in a parking slot, starts its read_timeout"""
+        if track.parked is None:
+            track.parked = time.time()
+
+    def add_read(self, track, number, color):
+        track.add_read(number, color, self.min_chars)
+
+    def needs_read(self, track):
+        """Whether the plate of track is still being read, its plate may change until then"""
+        return not track.frozen and track.reads < self.max_reads and \
+            (track.parked is None or time.time() - track.parked < self.read_timeout)
+
 def normalize_license_plate(plate_text):
     """Normalize license plate text format"""
     if plate_text == "None" or not plate_text:
@@ -130,30 +441,366 @@ def normalize_license_plate(plate_text):
     
     return plate_text
 
-def send_parking_data(api_url, recognition_results):
-    """Send parking data to API endpoint"""
+# Results of send_parking_data()
+SENT = 'sent'
+REJECTED = 'rejected'  # the API refused the data (4xx), sending it again will not help
+FAILED = 'failed'  # connection error, timeout or server error, retry later
+
+def send_parking_data(api_url, recognition_results, session=None, timeout=10):
+    """Send parking data to API endpoint, reusing the keep-alive connection of session if given
+
+    Returns SENT, REJECTED or FAILED.
+    """
     try:
         headers = {'Content-Type': 'application/json'}
-        response = requests.post(
+        response = (session or requests).post(
             api_url,
             json=recognition_results,
             headers=headers,
-            timeout=10
+            timeout=timeout
         )
         
         if response.status_code == 200:
             print("? Data sent successfully")
-            return True
+            return SENT
         else:
             print(f"? Failed to send data: {response.status_code}")
             print(f"Error: {response.text}")
-            return False
+            # Timeouts and rate limits are worth retrying, other client errors are not
+            if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                return REJECTED
+            return FAILED
     except requests.exceptions.ConnectionError:
         print("? Cannot connect to API service")
-        return False
+        return FAILED
     except requests.exceptions.Timeout:
         print("? API request timeout")
-        return False
+        return FAILED
     except Exception as e:
         print(f"? Error sending data: {e}")
-        return False 
\ No newline at end of file
+        return FAILED
+
+class EventOutbox:
+    """Append-only SQLite outbox of parking events, kept on disk until the API acknowledges them
+
+    At most max_events are kept, the oldest events are dropped first. Events the API
+    rejects are moved to the rejected table, so they cannot block the events after them.
+    """
+    def __init__(self, path='outbox.db', max_events=100000):
+        self.path = path
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rejected (seq INTEGER PRIMARY KEY, payload TEXT NOT NULL, "
+                          "rejected_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+        self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def append(self, events):
+        """Durably record events"""
+        with self.lock:
+            self.conn.executemany("INSERT INTO events (payload) VALUES (?)", [(json.dumps(e),) for e in events])
+            self.conn.execute("DELETE FROM events WHERE seq <= (SELECT MAX(seq) FROM events) - ?", (self.max_events,))
+            self.conn.commit()
+
+    def peek(self, n=100):
+        """Return (last seq, events) of the n oldest events"""
+        with self.lock:
+            rows = self.conn.execute("SELECT seq, payload FROM events ORDER BY seq LIMIT ?", (n,)).fetchall()
+        return (rows[-1][0] if rows else 0), [json.loads(payload) for _, payload in rows]
+
+    def ack(self, seq):
+        """Drop events up to seq once the API has stored them"""
+        with self.lock:
+            self.conn.execute("DELETE FROM events WHERE seq <= ?", (seq,))
+            self.conn.commit()
+
+    def reject(self, seq):
+        """Move events up to seq to the rejected table, for inspection"""
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO rejected (seq, payload) SELECT seq, payload FROM events WHERE seq <= ?",
+                              (seq,))
+            self.conn.execute("DELETE FROM events WHERE seq <= ?", (seq,))
+            self.conn.execute("DELETE FROM rejected WHERE seq <= (SELECT MAX(seq) FROM rejected) - ?", (self.max_events,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class TelemetrySender:
+    """Send parking data from a background thread so the detection loop never waits on the API
+
+    Only slots whose state changed since the last submit are sent, stamped with
+    the edge-side time, plus a full sync of every slot each full_sync_interval
+    seconds as a heartbeat. With an outbox, changes are written to disk first
+    and drained in batches of batch_size, so arrivals during an API outage are
+    not lost. Heartbeats are coalesced to the latest state per slot in memory.
+    """
+    def __init__(self, api_url=API_URL, timeout=10, retry_interval=2.0, full_sync_interval=60.0, outbox=None,
+                 batch_size=100):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.retry_interval = retry_interval  # seconds to wait after a failed send
+        self.full_sync_interval = full_sync_interval  # seconds between full syncs
+        self.outbox = outbox  # EventOutbox for durable changes, None to keep them in memory only
+        self.batch_size = batch_size  # max outbox events per request
+        self.session = requests.Session()  # keep-alive connection reused for every send
+        self.pending = {}  # slot ID -> latest state not sent yet
+        self.last = {}  # slot ID -> last submitted state, what the API has once pending is sent
+        self.last_full_sync = 0.0
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, recognition_results):
+        """Queue the slot states that changed, returns immediately"""
+        timestamp = datetime.now(timezone.utc).isoformat()
+        full_sync = time.time() - self.last_full_sync > self.full_sync_interval
+        if full_sync:
+            self.last_full_sync = time.time()
+        changes = []
+        with self.lock:
+            for result in recognition_results:
+                changed = self.last.get(result['ID']) != result
+                if changed or full_sync:
+                    state = dict(result, Timestamp=timestamp)
+                    if changed and self.outbox is not None:
+                        changes.append(state)
+                        self.pending.pop(result['ID'], None)  # superseded by the outbox event
+                    else:
+                        self.pending[result['ID']] = state
+                    self.last[result['ID']] = dict(result)
+        if changes:
+            self.outbox.append(changes)
+        if changes or self.pending:
+            self.event.set()
+
+    def drain_outbox(self):
+        """Send outbox events oldest first, returns False if the API is unreachable
+
+        When the API rejects a batch, events are sent one at a time to find the rejected
+        ones, which are logged and moved out of the outbox.
+        """
+        batch_size = self.batch_size
+        while self.running:
+            seq, events = self.outbox.peek(batch_size)
+            if not events:
+                return True
+            result = send_parking_data(self.api_url, events, self.session, self.timeout)
+            if result == FAILED:
+                return False
+            if result == REJECTED and len(events) > 1:
+                batch_size = 1
+            elif result == REJECTED:
+                print(f"? Event rejected by the API, moved out of the outbox: {events[0]}")
+                self.outbox.reject(seq)
+                batch_size = self.batch_size
+            else:
+                self.outbox.ack(seq)
+        return True
+
+    def run(self):
+        # Send pending data in a daemon thread
+        while self.running:
+            self.event.wait()
+            self.event.clear()
+            if self.outbox is not None and not self.drain_outbox():
+                time.sleep(self.retry_interval)
+                self.event.set()
+                continue
+
+            with self.lock:
+                data, self.pending = list(self.pending.values()), {}
+            if not data:
+                continue
+            result = send_parking_data(self.api_url, data, self.session, self.timeout)
+            if result == SENT:
+                continue
+            if result == REJECTED:
+                print(f"? States rejected by the API, dropped: {data}")
+                continue
+
+            # Requeue failed states unless the slot changed meanwhile, a newer state may be in the
+            # outbox rather than in pending and must not be overwritten by this one after it is sent
+            with self.lock:
+                for state in data:
+                    current = dict(state)
+                    current.pop('Timestamp', None)
+                    if self.last.get(state['ID']) == current:
+                        self.pending.setdefault(state['ID'], state)
+            time.sleep(self.retry_interval)
+            self.event.set()
+
+    def close(self, timeout=None):
+        """Stop the sender thread after it finishes the current send"""
+        self.running = False
+        self.event.set()
+        self.thread.join(timeout)
+        self.session.close()
+
+
+class StageTimer:
+    """Rolling per-stage latency of the edge detection loop
+
+    Stages are timed as laps: lap(stage) records the time since the previous lap of
+    the same thread, so consecutive laps split one frame into its stages, also when
+    the stages run on the threads of a pipeline. The last window samples of each
+    stage are kept for percentiles and a histogram, in milliseconds, and the depth
+    of watched queues is sampled each time an item is put.
+    """
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))  # histogram upper edges, ms
+
+    def __init__(self, window=500):
+        self.window = window
+        self.samples = {}  # stage -> deque of the last window durations, ms
+        self.counts = {}  # stage -> total number of samples
+        self.queues = {}  # name -> watched queue.Queue
+        self.depths = {}  # name -> deque of the last window queue depths
+        self.lock = threading.Lock()
+        self.local = threading.local()  # t: end of the previous lap of this thread
+        self.frame_t = time_synchronized()  # end of the previous frame
+
+    def record(self, stage, ms):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.window)
+                self.counts[stage] = 0
+            self.samples[stage].append(ms)
+            self.counts[stage] += 1
+
+    def start(self):
+        """Start the next lap of this thread now, e.g. after waiting on a queue"""
+        self.local.t = time_synchronized()
+
+    def lap(self, stage):
+        """Record the time since the previous lap of this thread as stage, waits for queued CUDA work first"""
+        t = time_synchronized()
+        self.record(stage, 1E3 * (t - getattr(self.local, 't', self.frame_t)))
+        self.local.t = t
+
+    def frame(self):
+        """Record the time since the previous frame, returns it in ms"""
+        t = time_synchronized()
+        ms = 1E3 * (t - self.frame_t)
+        self.record('frame', ms)
+        self.frame_t = self.local.t = t
+        return ms
+
+    def watch(self, name, q):
+        """Report the depth of queue q as name"""
+        with self.lock:
+            self.queues[name] = q
+            self.depths[name] = deque(maxlen=self.window)
+
+    def sample(self, name):
+        """Record the current depth of the watched queue name"""
+        depth = self.queues[name].qsize()
+        with self.lock:
+            self.depths[name].append(depth)
+
+    def summary(self):
+        """Per-stage count, mean, percentiles and histogram over the rolling window, ms
+
+        Watched queues are reported under 'queues' with their current, mean and max depth.
+        """
+        with self.lock:
+            samples = {stage: np.array(v) for stage, v in self.samples.items()}
+            counts = dict(self.counts)
+            depths = {name: list(v) for name, v in self.depths.items()}
+        summary = {}
+        for stage, ms in samples.items():
+            p50, p90, p99 = np.percentile(ms, (50, 90, 99))
+            hist = np.histogram(ms, bins=(0,) + self.BUCKETS)[0]
+            summary[stage] = {
+                'count': counts[stage],
+                'mean': round(float(ms.mean()), 2),
+                'p50': round(float(p50), 2),
+                'p90': round(float(p90), 2),
+                'p99': round(float(p99), 2),
+                'max': round(float(ms.max()), 2),
+                'hist': {f'<{edge:g}': int(n) for edge, n in zip(self.BUCKETS, hist)}  # samples per bucket
+            }
+        if depths:
+            summary['queues'] = {name: {
+                'depth': self.queues[name].qsize(),
+                'maxsize': self.queues[name].maxsize,
+                'mean': round(float(np.mean(d)), 2) if d else 0.0,
+                'max': max(d, default=0)
+            } for name, d in depths.items()}
+        return summary
+
+
+def serve_timing(timer, port, host='127.0.0.1'):
+    """Serve timer.summary() as JSON on http://host:port/ from a daemon thread"""
+    class TimingHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(timer.summary()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keep the detection log clean
+
+    server = ThreadingHTTPServer((host, port), TimingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Stage timings served on http://{host}:{port}/')
+    return server
+
+
+class PipelineStage(threading.Thread):
+    """One stage of the detection pipeline on its own daemon thread
+
+    Runs fn(item) for every item of source, a dataset or the previous stage, and
+    puts the results that are not None into a bounded queue, so a slow stage
+    blocks the stages before it instead of piling up frames. Iterate the stage to
+    get its results; an exception in the stage is raised again in the consumer.
+    """
+    END = object()  # end of the stream
+
+    def __init__(self, name, fn, source, maxsize=2, timer=None):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.source = source
+        self.queue = queue.Queue(maxsize)
+        self.timer = timer  # optional StageTimer, reports the queue depth
+        self.error = None
+        if timer:
+            timer.watch(name, self.queue)
+        self.start()
+
+    def run(self):
+        try:
+            for item in self.source:
+                if self.timer:
+                    self.timer.start()  # do not count the wait for the item
+                result = self.fn(item)
+                if result is not None:
+                    self.queue.put(result)
+                    if self.timer:
+                        self.timer.sample(self.name)
+                        self.timer.start()  # do not count the wait for the next stage
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(self.END)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self.END:
+                if self.error:
+                    raise self.error
+                return
+            yield item